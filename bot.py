@@ -1,13 +1,19 @@
 import os
+from typing import Optional
 
+import aiohttp
 import discord
 from discord.ext import commands
 
 from storage.confighelper import setup_config, get_config
-from storage.databasehelper import setup_database
+from storage.databasehelper import setup_database, close_database
+from util.downloads import create_http_session
 from util.gptapi import setup_openai
+from util.promptprefix import setup_prompt_prefix
+from util.tokens import setup_tokenizer_pool, close_tokenizer_pool
 
 setup_config()
+setup_tokenizer_pool()
 setup_database()
 
 
@@ -23,6 +29,7 @@ class GPTHelper(commands.Bot):
             command_prefix="!",
             help_command=None,
             intents=discord_intents)
+        self.http_session: Optional[aiohttp.ClientSession] = None
 
     async def load_commands(self) -> None:
         for file in os.listdir(f"{os.path.realpath(os.path.dirname(__file__))}/commands"):
@@ -49,13 +56,20 @@ class GPTHelper(commands.Bot):
     async def setup_hook(self) -> None:
         print(f"Logged in as {self.user.name}")
         print("-------------------")
+        self.http_session = create_http_session()
         await self.load_commands()
         await self.load_events()
 
+    async def close(self) -> None:
+        await super().close()
+        if self.http_session is not None:
+            await self.http_session.close()
+        close_tokenizer_pool()
+        close_database()
+
     async def on_message(self, message: discord.Message) -> None:
-        if message.author == self.user or message.author.bot:
-            return
-        await self.process_commands(message)
+        # Every message is classified once by the Router cog, which also runs prefix commands.
+        pass
 
 
 intents = discord.Intents.default()
@@ -63,5 +77,6 @@ intents.guild_messages, intents.message_content, intents.reactions = True, True,
 client = GPTHelper(discord_intents=intents)
 
 setup_openai()
+setup_prompt_prefix()
 
 client.run(get_config().discord_token)
@@ -1,10 +1,11 @@
+from datetime import datetime, timezone
 from decimal import Decimal, ROUND_HALF_UP
 
 import discord
 from discord import app_commands
 from discord.ext import commands
 
-from storage.databasehelper import get_requests
+from storage.databasehelper import get_billing_totals
 from util.builder import geterrorembedbuilder, getbaseembedbuilder, getnopermsembedbuilder
 
 
@@ -19,8 +20,14 @@ class Billing(commands.Cog, name="billing"):
     @commands.guild_only()
     @app_commands.describe(
         user="The user to get the billing information for.",
+        period="The time range to get the billing information for."
     )
-    async def billing(self, interaction: discord.Interaction, user: discord.User = None) -> None:
+    @app_commands.choices(period=[
+        app_commands.Choice(name="All time", value="all"),
+        app_commands.Choice(name="This month", value="month")
+    ])
+    async def billing(self, interaction: discord.Interaction, user: discord.User = None,
+                      period: app_commands.Choice[str] = None) -> None:
         member = await interaction.guild.fetch_member(interaction.user.id)
         if member is None:
             eb = geterrorembedbuilder("Member null", "Member is null")
@@ -35,7 +42,13 @@ class Billing(commands.Cog, name="billing"):
             eb = getnopermsembedbuilder()
             await interaction.response.send_message(embed=eb, ephemeral=True)
             return
-        if get_requests().get(target_id) is None:
+        period_name = "All time"
+        period_key = "all"
+        if period is not None and period.value == "month":
+            period_name = "This month"
+            period_key = datetime.now(timezone.utc).strftime('%Y-%m')
+        totals = get_billing_totals(target_id, period_key)
+        if len(totals) == 0:
             eb = (getbaseembedbuilder()
                   .settitle("No Information")
                   .setdescription("No billing information available for this user.")
@@ -44,11 +57,11 @@ class Billing(commands.Cog, name="billing"):
             await interaction.response.send_message(embed=eb, ephemeral=True)
             return
 
-        requests = get_requests().get(target_id)
-        input_cost, output_cost, total_cost = 0.0, 0.0, 0.0
-        for request in requests:
-            input_cost += ((request.model.input_cost() / 1000.0) * request.model.input_cost())
-            output_cost += ((request.model.output_cost() / 1000.0) * request.model.output_cost())
+        requests, input_cost, output_cost = 0, 0.0, 0.0
+        for total in totals:
+            requests += total.requests
+            input_cost += total.input_cost()
+            output_cost += total.output_cost()
 
         input_cost = Decimal(input_cost).quantize(Decimal('0.00001'), rounding=ROUND_HALF_UP)
         output_cost = Decimal(output_cost).quantize(Decimal('0.00001'), rounding=ROUND_HALF_UP)
@@ -60,13 +73,18 @@ class Billing(commands.Cog, name="billing"):
               .settitle("Billing Information")
               .setdescription("Below is the breakdown for the user's usage of the bot")
               .addfield("Username", target.name, True)
-              .addfield("GPT Requests", f"{len(requests)}", True)
+              .addfield("Period", period_name, True)
+              .addfield("GPT Requests", f"{requests}", True)
               .addfield("Input Cost", f"${input_cost}", True)
               .addfield("Output Cost", f"${output_cost}", True)
               .addfield("Total Cost", f"${total_cost}", True)
-              .black()
-              .build())
-        await interaction.response.send_message(embed=eb, ephemeral=True)
+              .black())
+        for total in totals:
+            model_cost = Decimal(total.cost).quantize(Decimal('0.00001'), rounding=ROUND_HALF_UP)
+            eb.addfield(total.model.model_name(),
+                        f"Requests: {total.requests}\nInput Tokens: {total.input_tokens}"
+                        f"\nOutput Tokens: {total.output_tokens}\nCost: ${model_cost}", True)
+        await interaction.response.send_message(embed=eb.build(), ephemeral=True)
 
 
 async def setup(bot) -> None:
@@ -0,0 +1,30 @@
+from discord.ext import commands
+
+from util.builder import getbaseembedbuilder
+from util.responsecache import get_response_cache
+
+
+class CacheStats(commands.Cog, name="cachestats"):
+    def __init__(self, bot) -> None:
+        self.bot = bot
+
+    @commands.command(
+        name="cachestats",
+        description="Show the response cache hit and miss counters"
+    )
+    @commands.is_owner()
+    @commands.guild_only()
+    async def cachestats(self, ctx: commands.Context) -> None:
+        cache = get_response_cache()
+        eb = (getbaseembedbuilder()
+              .settitle("Response Cache")
+              .setdescription(f"Hit rate since startup: {cache.hit_rate():.1%}")
+              .black())
+        eb.addfield("Hits", str(cache.hits), True)
+        eb.addfield("Misses", str(cache.misses), True)
+        eb.addfield("Entries in memory", str(len(cache.entries)), True)
+        await ctx.send(embed=eb.build())
+
+
+async def setup(bot) -> None:
+    await bot.add_cog(CacheStats(bot))
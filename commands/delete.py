@@ -2,7 +2,7 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 
-from storage.databasehelper import remove_user, get_gpt_users
+from storage.databasehelper import remove_user, get_gpt_user_by_id
 from util.builder import getbaseembedbuilder, geterrorembedbuilder, getnopermsembedbuilder
 
 
@@ -19,7 +19,7 @@ class Delete(commands.Cog, name="delete"):
         user="The user to delete the data for."
     )
     async def delete(self, interaction: discord.Interaction, user: discord.User) -> None:
-        member = interaction.guild.fetch_member(interaction.user.id)
+        member = await interaction.guild.fetch_member(interaction.user.id)
         if member is None:
             eb = geterrorembedbuilder("Member null", "Member is null")
             await interaction.response.send_message(embed=eb, ephemeral=True)
@@ -28,12 +28,12 @@ class Delete(commands.Cog, name="delete"):
             await interaction.response.send_message(getnopermsembedbuilder(), ephemeral=True)
             return
 
-        if get_gpt_users()[user.id] is None:
+        gpt_user = get_gpt_user_by_id(user.id)
+        if gpt_user is None:
             eb = geterrorembedbuilder("User not foundl", "The user specified was not found. Please try again.")
             await interaction.response.send_message(embed=eb, ephemeral=True)
             return
 
-        gpt_user = get_gpt_users()[user.id]
         remove_user(gpt_user)
         textchannel = interaction.guild.get_channel(gpt_user.gpt_channel.id)
         if textchannel is not None:
@@ -3,7 +3,7 @@ from discord import app_commands
 from discord.ext import commands
 
 from storage.classes import Model
-from storage.databasehelper import get_gpt_users
+from storage.databasehelper import get_gpt_user, save_user
 from util.builder import getbaseembedbuilder, geterrorembedbuilder
 
 
@@ -30,12 +30,7 @@ class Settings(commands.Cog, name="settings"):
         channel = interaction.channel
         if isinstance(channel, discord.Thread):
             channel = channel.parent
-        gpt_user = None
-
-        for user in get_gpt_users():
-            if user.id == interaction.message.author.id and user.gpt_channel.id == channel.id:
-                gpt_user = user
-                break
+        gpt_user = get_gpt_user(interaction.user.id, channel.id)
         if gpt_user is None:
             eb = geterrorembedbuilder("Unavailable",
                                       "You can only use this command in a chat thread or a chat channel.")
@@ -61,6 +56,7 @@ class Settings(commands.Cog, name="settings"):
         gpt_user.gpt_channel.current_model = model
         gpt_user.gpt_channel.current_temperature = temperature
         gpt_user.gpt_channel.current_max_tokens = max_tokens
+        save_user(gpt_user)
         await interaction.response.send_message(
             embed=getbaseembedbuilder()
             .settitle("Settings updated")
@@ -1,68 +1,57 @@
 import discord
 from discord.ext import commands
 
-from storage.databasehelper import get_gpt_users
+from storage.classes import GPTUser
+from storage.databasehelper import save_user
 from util.builder import geterrorembedbuilder, getbaseembedbuilder
+from util.chatthreads import add_chat_thread, remove_chat_thread, CHAT_THREAD_PREFIX
 
 
 class Chats(commands.Cog):
     def __init__(self, bot) -> None:
         self.bot = bot
 
-    @commands.Cog.listener()
-    async def on_message(self, message: discord.Message) -> None:
-        if message.author == self.bot.user or message.author.bot:
-            return
+    async def start_chat(self, message: discord.Message, gpt_user: GPTUser) -> None:
         channel = message.channel
-        thread = None
-        is_thread = isinstance(channel, discord.Thread)
-        if is_thread:
-            thread = channel
-            channel = channel.parent
-        gpt_user = next(
-            (user for user in get_gpt_users() if user.id == message.author.id and user.gpt_channel.id == channel.id),
-            None)
-        if gpt_user is None:
-            return
+        if gpt_user.currently_chatting:
+            threads = channel.threads
+            threads = [thread for thread in threads if thread.owner_id == self.bot.user.id and not thread.archived]
+            if len(threads) != 0:
+                await channel.send(embed=geterrorembedbuilder("You have already started a chat",
+                                                              "You can only start one chat at a time"))
+                return
+        gpt_user.currently_chatting = True
+        gpt_user.chats += 1
+        save_user(gpt_user)
+        thread = await channel.create_thread(
+            name=f"{CHAT_THREAD_PREFIX}{message.author.name} - {gpt_user.chats}",
+            reason="gpt-bot"
+        )
+        add_chat_thread(thread.id)
+        await thread.add_user(message.author)
+        await message.reply(
+            "Created chat thread. You can now chat with the bot. Type `close chat` to close the chat.")
 
-        if message.content == "start chat":
-            if gpt_user.currently_chatting:
-                threads = channel.threads
-                threads = [thread for thread in threads if thread.owner_id == self.bot.user.id and not thread.archived]
-                if len(threads) != 0:
-                    await channel.send(embed=geterrorembedbuilder("You have already started a chat",
-                                                                  "You can only start one chat at a time"))
-                    return
-            gpt_user.currently_chatting = True
-            gpt_user.chats += 1
-            thread = await message.channel.create_thread(
-                name=f"GPT Chat - {message.author.name} - {gpt_user.chats}",
-                reason="gpt-bot"
-            )
-            await thread.add_user(message.author)
-            await message.reply(
-                "Created chat thread. You can now chat with the bot. Type `close chat` to close the chat.")
-            return
-        if not is_thread:
-            return
-        if thread.owner_id != self.bot.user.id or thread.archived or thread.locked or not thread.name.startswith(
-                "GPT Chat - "):
-            return
-        if message.content == "close chat" or message.content == "stop chat":
-            gpt_user.currently_chatting = False
-            await thread.send(
-                embed=getbaseembedbuilder().settitle("Thread Closed").setdescription(
-                    "The thread has been closed by the user.").black().build()
-            )
-            await thread.edit(archived=True, locked=True)
-            return
-        if message.content == "restart chat":
-            await thread.edit(archived=True, locked=True)
-            gpt_user.chats += 1
-            await channel.create_thread(name=f"GPT Chat - {message.author.name} - {gpt_user.chats}")
-            await thread.add_user(message.author)
-            return
-        pass
+    async def close_chat(self, message: discord.Message, thread: discord.Thread, gpt_user: GPTUser) -> None:
+        gpt_user.currently_chatting = False
+        save_user(gpt_user)
+        remove_chat_thread(thread.id)
+        await thread.send(
+            embed=getbaseembedbuilder().settitle("Thread Closed").setdescription(
+                "The thread has been closed by the user.").black().build()
+        )
+        await thread.edit(archived=True, locked=True)
+
+    async def restart_chat(self, message: discord.Message, thread: discord.Thread, gpt_user: GPTUser) -> None:
+        remove_chat_thread(thread.id)
+        await thread.edit(archived=True, locked=True)
+        gpt_user.chats += 1
+        save_user(gpt_user)
+        new_thread = await thread.parent.create_thread(
+            name=f"{CHAT_THREAD_PREFIX}{message.author.name} - {gpt_user.chats}"
+        )
+        add_chat_thread(new_thread.id)
+        await new_thread.add_user(message.author)
 
 
 async def setup(bot) -> None:
@@ -1,174 +1,274 @@
 import asyncio
-import tempfile
+import random
+import time
+from typing import Dict, List, Optional
 
-import aiohttp
 import discord
 import openai
 from discord.ext import commands
 
-from storage.classes import GPTMessage, RunResponse, RunResult, GPTRequest
+from storage.classes import GPTMessage, RunResponse, RunResult, GPTRequest, GPTUser, CachedFile
 from storage.confighelper import get_config
-from storage.databasehelper import get_gpt_users, add_request
+from storage.databasehelper import add_request
+from util.assistants import get_assistant_id, forget_assistant, schedule_cleanup
 from util.builder import geterrorembedbuilder
-from util.gptapi import get_api
-from util.utils import discord_message_to_gptmessage, generate_completion_response, process_response, \
-    split_into_shorter_messages, num_tokens_from_bytes, num_tokens_from_string, num_tokens_from_list
+from util.conversationcache import get_conversation, update_message, remove_message, \
+    evict_conversation, ThreadConversation, HISTORY_LIMIT
+from util.downloads import Download, download_attachments
+from util.filecache import acquire_file, release_file, forget_file, start_file_gc, stop_file_gc
+from util.gptapi import get_api, get_scheduler
+from util.sender import send_reply
+from util.summarizer import compact_conversation, digest_attachment
+from util.tokens import num_tokens_from_string_async, num_tokens_from_list, \
+    decode_bytes_async, prime_gpt_message_tokens
+from util.utils import generate_completion_response, stream_completion_response, process_response
 
 
 class Completer(commands.Cog):
     def __init__(self, bot) -> None:
         self.bot = bot
+        self.bursts: Dict[int, List[discord.Message]] = {}
+        self.debounce_tasks: Dict[int, asyncio.Task] = {}
+        self.responding: Dict[int, asyncio.Task] = {}
 
-    @commands.Cog.listener()
-    async def on_message(self, message: discord.Message) -> None:
-        if message.author == self.bot.user or message.author.bot:
-            return
+    async def cog_load(self) -> None:
+        start_file_gc()
 
-        channel = message.channel
-        if not isinstance(channel, discord.Thread):
-            return
+    async def cog_unload(self) -> None:
+        stop_file_gc()
 
-        # ignore threads not created by the bot
-        thread = channel
-        if thread.owner_id != self.bot.user.id:
-            return
+    async def queue_completion(self, message: discord.Message, thread: discord.Thread, gpt_user: GPTUser) -> None:
+        conversation = await get_conversation(thread)
+        conversation.record(message)
 
-        # ignore threads that are archived locked or title is not what we want
-        if thread.archived or thread.locked or not thread.name.startswith("GPT Chat -"):
-            # ignore this thread
-            return
-
-        gpt_user = None
-        for user in get_gpt_users():
-            if user.id == message.author.id and user.gpt_channel.id == thread.parent.id:
-                gpt_user = user
-                break
-        if gpt_user is None:
-            return
+        # Collect messages sent in quick succession and answer them with a single completion.
+        self.bursts.setdefault(thread.id, []).append(message)
+        pending = self.debounce_tasks.get(thread.id)
+        if pending is not None:
+            pending.cancel()
+        self.debounce_tasks[thread.id] = asyncio.create_task(self.debounce(thread, gpt_user))
 
-        if message.content == "close chat" or message.content == "restart chat" or message.content == "stop chat":
+    async def debounce(self, thread: discord.Thread, gpt_user: GPTUser) -> None:
+        async with thread.typing():
+            await asyncio.sleep(get_config().debounce_interval)
+            # Only one reply is generated per thread at a time, so the next burst waits for the current one.
+            running = self.responding.get(thread.id)
+            if running is not None:
+                await asyncio.wait({running})
+            self.debounce_tasks.pop(thread.id, None)
+            messages = self.bursts.pop(thread.id, [])
+        if not messages:
             return
+        task = asyncio.create_task(self.respond(thread, gpt_user, messages))
+        self.responding[thread.id] = task
+        try:
+            await task
+        except asyncio.CancelledError:
+            # The reply was stopped by cancel_thread; only propagate if this task itself is being cancelled.
+            if asyncio.current_task().cancelling():
+                raise
+        except Exception as e:
+            print(f"Failed to respond in thread {thread.id}\n{type(e).__name__}: {e}")
+        finally:
+            if self.responding.get(thread.id) is task:
+                del self.responding[thread.id]
 
-        message_count = 0
+    def cancel_thread(self, thread_id: int) -> None:
+        # The thread is being closed, so drop queued messages and stop any reply that is still being generated.
+        pending = self.debounce_tasks.pop(thread_id, None)
+        if pending is not None:
+            pending.cancel()
+        self.bursts.pop(thread_id, None)
+        running = self.responding.pop(thread_id, None)
+        if running is not None:
+            running.cancel()
 
-        async for _ in message.channel.history(limit=None):
-            message_count += 1
+    async def respond(self, thread: discord.Thread, gpt_user: GPTUser, messages: List[discord.Message]) -> None:
+        attachments = [attachment for burst_message in messages for attachment in burst_message.attachments]
+        conversation = await get_conversation(thread)
 
-        if message_count > 200:
+        if conversation.message_count > HISTORY_LIMIT:
             await thread.send(embed=
             geterrorembedbuilder(
                 "Too many messages",
                 "You have sent too many messages in this thread. Please restart the chat."))
             return
 
-        # Maybe put a wait if user has more messages (later)
+        (summary, channel_messages), downloads = await asyncio.gather(
+            compact_conversation(conversation, gpt_user),
+            download_attachments(self.bot.http_session, attachments)
+        )
+        try:
+            await self.answer(thread, gpt_user, messages, conversation, summary, channel_messages, downloads)
+        finally:
+            for download in downloads:
+                if download is not None:
+                    download.close()
+
+    async def answer(self, thread: discord.Thread, gpt_user: GPTUser, messages: List[discord.Message],
+                     conversation: ThreadConversation, summary: Optional[str], channel_messages: List[GPTMessage],
+                     downloads: List[Optional[Download]]) -> None:
+        channel = thread
+        message = messages[-1]
+        content = "\n".join(burst_message.content for burst_message in messages if burst_message.content)
+        attachments = [attachment for burst_message in messages for attachment in burst_message.attachments]
         gpt_channel = gpt_user.gpt_channel
-        channel_messages = [
-            discord_message_to_gptmessage(message) async for message in thread.history(limit=200)
-        ]
-        for attachment in message.attachments:
+        attached = {download.sha256() for download in downloads if download is not None}
+        channel_messages = [digest for sha256, digest in conversation.attachments.items() if sha256 not in attached] \
+            + channel_messages
+        for attachment, download in zip(attachments, downloads):
             if attachment.filename.endswith(".txt"):
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(attachment.url) as resp:
-                        if resp.status != 200:
-                            await channel.send(f"Warning: Could not download file with name: {attachment.filename}")
-                            continue
-                        data = await resp.text()
-                        channel_messages.append(GPTMessage(user=message.author.name, text=data))
-
-        channel_messages = [x for x in channel_messages if x is not None]
-        channel_messages.reverse()
-
-        for attachment in message.attachments:
+                if download is None:
+                    await channel.send(f"Warning: Could not download file with name: {attachment.filename}")
+                    continue
+                data = await decode_bytes_async(download.read())
+                if await num_tokens_from_string_async(data, gpt_channel.current_model) \
+                        > get_config().digest_threshold_tokens:
+                    digest = await digest_attachment(data, download.sha256(), gpt_user)
+                    if digest is not None:
+                        data = f"Notes on the attached file {attachment.filename}:\n{digest}"
+                        conversation.attachments[download.sha256()] = GPTMessage(user=message.author.name, text=data)
+                channel_messages.append(GPTMessage(user=message.author.name, text=data))
+
+        for attachment, download in zip(attachments, downloads):
             if not attachment.filename.endswith(".txt"):
                 await channel.send(
                     "Sending file through Assistants API Beta. Currently, this does not support past context. This may take a while.")
                 async with thread.typing():
+                    if download is None:
+                        await channel.send(f"Warning: Could not download file with name: {attachment.filename}")
+                        return
                     api = await get_api()
-                    assistant = await api.beta.assistants.create(
-                        name=f'{message.author.name} - {gpt_user.chats}',
-                        instructions=get_config().instructions,
-                        tools=[{"type": "retrieval"}, {"type": "code_interpreter"}],
-                        model=gpt_channel.current_model.model_name()
-                    )
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(attachment.url) as resp:
-                            if resp.status != 200:
-                                await channel.send(f"Warning: Could not download file with name: {attachment.filename}")
-                                return
-                            data = await resp.read()
-                    with tempfile.NamedTemporaryFile(delete=True) as temp:
-                        temp.write(data)
-                        temp.flush()
-                        temp.seek(0)
-                        file_data = temp.read()
-                    response = await api.files.create(file=file_data, purpose="assistants")
-                    thread_o = await api.beta.threads.create(
-                        messages=[
-                            {
-                                "role": "user",
-                                "content": message.content if message.content else " ",
-                                "file_ids": [response.id]
-                            }
-                        ]
-                    )
-                    run = await api.beta.threads.runs.create(
-                        thread_id=thread_o.id,
-                        assistant_id=assistant.id,
-                    )
-                    resp = await periodic_retrieval(api=api, thread_id=thread_o.id, run_id=run.id)
-                    input_tokens = num_tokens_from_bytes(file_data, gpt_channel.current_model)
-                    input_tokens += num_tokens_from_string(message.content, gpt_channel.current_model)
-                    output_tokens = num_tokens_from_list(resp.messages.data, gpt_channel.current_model)
-                    req = GPTRequest(
-                        model=gpt_channel.current_model,
-                        input_tokens=input_tokens,
-                        output_tokens=output_tokens
-                    )
-                    add_request(user=gpt_user, request=req)
-                    latest_resp = ""
-                    for processed in resp.messages.data:
-                        if processed.role == "assistant":
-                            latest_resp = processed.content[0].text.value
-                    if latest_resp == "":
-                        await channel.send("There was no response from the Assistant.")
-                    else:
-                        shortened_resps = split_into_shorter_messages(latest_resp)
-                        for resp in shortened_resps:
-                            await channel.send(resp)
-                    await api.beta.threads.delete(thread_o.id)
-                    await api.files.delete(response.id)
-                    await api.beta.assistants.delete(assistant.id)
+                    cached_file = await acquire_file(download, gpt_channel.current_model)
+                    try:
+                        await self.run_assistant(api, channel, gpt_user, content, cached_file)
+                    finally:
+                        release_file(cached_file)
                     return
 
         # generate the response
         async with thread.typing():
-
-            response_data = await generate_completion_response(
-                messages=channel_messages,
-                channel_config=gpt_channel,
-            )
+            await prime_gpt_message_tokens(channel_messages, gpt_channel.current_model)
+            if get_config().stream_responses:
+                response_data = await stream_completion_response(
+                    messages=channel_messages,
+                    channel_config=gpt_channel,
+                    user_id=gpt_user.id,
+                    thread=thread,
+                    summary=summary,
+                )
+            else:
+                response_data = await generate_completion_response(
+                    messages=channel_messages,
+                    channel_config=gpt_channel,
+                    user_id=gpt_user.id,
+                    summary=summary,
+                )
 
         await process_response(
             gpt_user=gpt_user, thread=thread, response_data=response_data
         )
 
+    async def run_assistant(self, api: openai.AsyncOpenAI, channel: discord.Thread, gpt_user: GPTUser,
+                            content: str, cached_file: CachedFile) -> None:
+        gpt_channel = gpt_user.gpt_channel
+        input_tokens = cached_file.tokens + await num_tokens_from_string_async(content, gpt_channel.current_model)
+        async with get_scheduler().slot(gpt_channel.current_model, gpt_user.id, input_tokens):
+            try:
+                thread_o = await api.beta.threads.create(
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": content if content else " ",
+                            "file_ids": [cached_file.file_id]
+                        }
+                    ]
+                )
+            except openai.BadRequestError:
+                # The cached file id may have been deleted remotely; upload it again next time.
+                forget_file(cached_file)
+                raise
+            try:
+                run = await api.beta.threads.runs.create(
+                    thread_id=thread_o.id,
+                    assistant_id=await get_assistant_id(gpt_channel.current_model),
+                )
+            except openai.NotFoundError:
+                # The cached assistant was deleted remotely, so create a fresh one.
+                forget_assistant(gpt_channel.current_model)
+                run = await api.beta.threads.runs.create(
+                    thread_id=thread_o.id,
+                    assistant_id=await get_assistant_id(gpt_channel.current_model),
+                )
+        resp = await periodic_retrieval(api=api, thread_id=thread_o.id, run_id=run.id)
+        output_tokens = num_tokens_from_list(resp.messages.data, gpt_channel.current_model)
+        req = GPTRequest(
+            model=gpt_channel.current_model,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            channel_id=gpt_channel.id
+        )
+        add_request(user=gpt_user, request=req)
+        latest_resp = ""
+        for processed in resp.messages.data:
+            if processed.role == "assistant":
+                latest_resp = processed.content[0].text.value
+        if resp.status is RunResult.EXPIRED:
+            await channel.send("The Assistant took too long to respond. Please try again.")
+        elif latest_resp == "":
+            await channel.send("There was no response from the Assistant.")
+        else:
+            await send_reply(channel, latest_resp)
+        # Deleting the run's thread is not needed for the reply, so it happens in the background.
+        schedule_cleanup(lambda cleanup_api: cleanup_api.beta.threads.delete(thread_o.id))
+
+    @commands.Cog.listener()
+    async def on_message_edit(self, before: discord.Message, after: discord.Message) -> None:
+        update_message(after)
 
-async def periodic_retrieval(api: openai.AsyncOpenAI, thread_id: str, run_id: str) -> RunResponse:
-    while True:
-        run = await api.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent) -> None:
+        remove_message(payload.channel_id, payload.message_id)
+
+    @commands.Cog.listener()
+    async def on_thread_update(self, before: discord.Thread, after: discord.Thread) -> None:
+        if after.archived or after.locked:
+            evict_conversation(after.id)
 
-        if run.status == "queued" or run.status == "in_progress":
-            await asyncio.sleep(10)
-            continue
-        break
+    @commands.Cog.listener()
+    async def on_raw_thread_delete(self, payload: discord.RawThreadDeleteEvent) -> None:
+        evict_conversation(payload.thread_id)
+
+
+async def periodic_retrieval(api: openai.AsyncOpenAI, thread_id: str, run_id: str) -> RunResponse:
+    # Poll quickly at first so short runs return promptly, then back off with jitter for long ones.
+    deadline = time.monotonic() + get_config().run_timeout
+    interval = get_config().run_poll_initial_interval
+    try:
+        while True:
+            run = await api.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
+            status = run.status
+            if status not in ("queued", "in_progress", "cancelling"):
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                schedule_cleanup(lambda cleanup_api: cleanup_api.beta.threads.runs.cancel(thread_id=thread_id,
+                                                                                          run_id=run_id))
+                status = "expired"
+                break
+            await asyncio.sleep(min(remaining, interval * random.uniform(0.8, 1.2)))
+            interval = min(interval * get_config().run_poll_backoff, get_config().run_poll_max_interval)
+    except asyncio.CancelledError:
+        # Nobody is waiting for the answer any more, so stop the run from using more tokens.
+        schedule_cleanup(lambda cleanup_api: cleanup_api.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id))
+        raise
     messages = await api.beta.threads.messages.list(
         thread_id=thread_id,
         order="asc"
     )
 
     try:
-        matched_status = RunResult[run.status.upper()]
+        matched_status = RunResult[status.upper()]
     except KeyError:
         matched_status = RunResult.UNKNOWN
 
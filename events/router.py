@@ -0,0 +1,77 @@
+from typing import Optional, Tuple
+
+import discord
+from discord.ext import commands
+
+from storage.classes import GPTUser, MessageRoute
+from storage.databasehelper import get_gpt_user, is_provisioned_channel
+from util.chatthreads import add_chat_thread, remove_chat_thread, is_chat_thread, is_open_chat_thread
+from util.conversationcache import record_message
+
+
+class Router(commands.Cog):
+    def __init__(self, bot) -> None:
+        self.bot = bot
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message) -> None:
+        channel = message.channel
+        if is_chat_thread(channel.id):
+            record_message(message)
+        if message.author.bot:
+            return
+        if message.content.startswith(self.bot.command_prefix):
+            await self.bot.process_commands(message)
+
+        route, gpt_user = self.classify(message)
+        if route is MessageRoute.IGNORE:
+            return
+        if route is MessageRoute.COMPLETION:
+            await self.bot.get_cog("Completer").queue_completion(message, channel, gpt_user)
+        elif route is MessageRoute.START_CHAT:
+            await self.bot.get_cog("Chats").start_chat(message, gpt_user)
+        elif route is MessageRoute.CLOSE_CHAT:
+            self.bot.get_cog("Completer").cancel_thread(channel.id)
+            await self.bot.get_cog("Chats").close_chat(message, channel, gpt_user)
+        elif route is MessageRoute.RESTART_CHAT:
+            self.bot.get_cog("Completer").cancel_thread(channel.id)
+            await self.bot.get_cog("Chats").restart_chat(message, channel, gpt_user)
+
+    def classify(self, message: discord.Message) -> Tuple[MessageRoute, Optional[GPTUser]]:
+        channel = message.channel
+        if isinstance(channel, discord.Thread):
+            if not is_chat_thread(channel.id):
+                # Threads from before a restart are picked up the first time someone writes in them.
+                if not is_provisioned_channel(channel.parent_id) or not is_open_chat_thread(channel, self.bot.user.id):
+                    return MessageRoute.IGNORE, None
+                add_chat_thread(channel.id)
+            elif channel.archived or channel.locked:
+                return MessageRoute.IGNORE, None
+            gpt_user = get_gpt_user(message.author.id, channel.parent_id)
+            if gpt_user is None:
+                return MessageRoute.IGNORE, None
+            if message.content == "close chat" or message.content == "stop chat":
+                return MessageRoute.CLOSE_CHAT, gpt_user
+            if message.content == "restart chat":
+                return MessageRoute.RESTART_CHAT, gpt_user
+            return MessageRoute.COMPLETION, gpt_user
+
+        if message.content != "start chat" or not is_provisioned_channel(channel.id):
+            return MessageRoute.IGNORE, None
+        gpt_user = get_gpt_user(message.author.id, channel.id)
+        if gpt_user is None:
+            return MessageRoute.IGNORE, None
+        return MessageRoute.START_CHAT, gpt_user
+
+    @commands.Cog.listener()
+    async def on_thread_update(self, before: discord.Thread, after: discord.Thread) -> None:
+        if after.archived or after.locked:
+            remove_chat_thread(after.id)
+
+    @commands.Cog.listener()
+    async def on_raw_thread_delete(self, payload: discord.RawThreadDeleteEvent) -> None:
+        remove_chat_thread(payload.thread_id)
+
+
+async def setup(bot) -> None:
+    await bot.add_cog(Router(bot))
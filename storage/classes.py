@@ -1,6 +1,7 @@
+import time
 from dataclasses import dataclass, field
 from enum import Enum
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from openai.resources.beta.threads import Messages
 
@@ -10,14 +11,16 @@ class ModelInfo:
     model_name: str
     input_cost: float
     output_cost: float
+    # Kept out of equality and hashing so ModelInfo values pickled before this field existed still match a member.
+    context_window: int = field(default=0, compare=False)
 
 
 @dataclass(frozen=True)
 class Model(Enum):
-    GPT_4_TURBO = ModelInfo("gpt-4-0125-preview", 0.01, 0.03)
-    GPT_4_TURBO_VISION = ModelInfo("gpt-4-1106-vision-preview", 0.01, 0.03)
-    GPT_3_5_TURBO = ModelInfo("gpt-3.5-turbo-0125", 0.0005, 0.0015)
-    DALL_E_3 = ModelInfo("dall-e-3", 0.04, 0.08)
+    GPT_4_TURBO = ModelInfo("gpt-4-0125-preview", 0.01, 0.03, 128000)
+    GPT_4_TURBO_VISION = ModelInfo("gpt-4-1106-vision-preview", 0.01, 0.03, 128000)
+    GPT_3_5_TURBO = ModelInfo("gpt-3.5-turbo-0125", 0.0005, 0.0015, 16385)
+    DALL_E_3 = ModelInfo("dall-e-3", 0.04, 0.08, 4096)
 
     def model_name(self) -> str:
         return self.value.model_name
@@ -28,6 +31,21 @@ class Model(Enum):
     def output_cost(self) -> float:
         return self.value.output_cost
 
+    def context_window(self) -> int:
+        return self.value.context_window
+
+    @classmethod
+    def from_model_name(cls, model_name: str) -> Optional['Model']:
+        for model in cls:
+            if model.model_name() == model_name:
+                return model
+        return None
+
+    @classmethod
+    def _missing_(cls, value):
+        # Legacy pickles look members up by ModelInfo value, which breaks whenever prices change.
+        return cls.from_model_name(getattr(value, 'model_name', value))
+
 
 @dataclass
 class GPTChannel:
@@ -50,6 +68,48 @@ class GPTRequest:
     model: Model
     input_tokens: int
     output_tokens: int
+    channel_id: int = 0
+    timestamp: float = field(default_factory=time.time)
+
+    def input_cost(self) -> float:
+        return (self.input_tokens / 1000.0) * self.model.input_cost()
+
+    def output_cost(self) -> float:
+        return (self.output_tokens / 1000.0) * self.model.output_cost()
+
+    def cost(self) -> float:
+        return self.input_cost() + self.output_cost()
+
+
+@dataclass
+class BillingTotals:
+    model: Model
+    requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cost: float = 0.0
+
+    def add(self, request: GPTRequest):
+        self.requests += 1
+        self.input_tokens += request.input_tokens
+        self.output_tokens += request.output_tokens
+        self.cost += request.cost()
+
+    def input_cost(self) -> float:
+        return (self.input_tokens / 1000.0) * self.model.input_cost()
+
+    def output_cost(self) -> float:
+        return (self.output_tokens / 1000.0) * self.model.output_cost()
+
+
+@dataclass
+class CachedFile:
+    sha256: str
+    file_id: str
+    tokens: int
+    encoding: str
+    refcount: int = 0
+    last_used: float = field(default_factory=time.time)
 
 
 @dataclass(frozen=True)
@@ -83,6 +143,7 @@ class GPTPrompt:
     header: GPTMessage
     examples: List[GPTConversation]
     convo: GPTConversation
+    summary: Optional[str] = None
 
     def full_render(self, bot_name):
         messages = [
@@ -91,6 +152,18 @@ class GPTPrompt:
                 "content": self.render_system_prompt(),
             }
         ]
+        for message in self.render_examples(bot_name):
+            messages.append(message)
+        messages.append(
+            {
+                "role": "system",
+                "content": GPTMessage(
+                    "System", "Now, you will work with the actual current conversation."
+                ).render(),
+            }
+        )
+        if self.summary is not None:
+            messages.append(self.render_summary(self.summary))
         for message in self.render_messages(bot_name):
             messages.append(message)
         return messages
@@ -99,27 +172,46 @@ class GPTPrompt:
         return f"\n{"<|endoftext|>"}".join(
             [self.header.render()]
             + [GPTMessage("System", "Example conversations:").render()]
-            + [
-                GPTMessage(
-                    "System", "Now, you will work with the actual current conversation."
-                ).render()
-            ]
         )
 
+    def render_examples(self, bot_name):
+        for conversation in self.examples:
+            for message in conversation.messages:
+                yield self.render_example(message, bot_name)
+
+    @staticmethod
+    def render_example(message, bot_name):
+        return {
+            "role": "system",
+            "name": "example_assistant" if bot_name in message.user else "example_user",
+            "content": message.text,
+        }
+
+    @staticmethod
+    def render_summary(summary):
+        return {
+            "role": "system",
+            "content": f"Summary of the earlier conversation: {summary}",
+        }
+
     def render_messages(self, bot_name):
         for message in self.convo.messages:
-            if not bot_name in message.user:
-                yield {
-                    "role": "user",
-                    "name": message.user,
-                    "content": message.text,
-                }
-            else:
-                yield {
-                    "role": "assistant",
-                    "name": bot_name,
-                    "content": message.text,
-                }
+            yield self.render_message(message, bot_name)
+
+    @staticmethod
+    def render_message(message, bot_name):
+        if not bot_name in message.user:
+            return {
+                "role": "user",
+                "name": message.user,
+                "content": message.text,
+            }
+        else:
+            return {
+                "role": "assistant",
+                "name": bot_name,
+                "content": message.text,
+            }
 
 
 example_conversations: List[GPTConversation] = [
@@ -151,6 +243,57 @@ class Configuration:
     guild_id: int = 0
     gptcategory_id: int = 0
     timeout: int = 120
+    database_flush_interval: float = 2.0
+    database_flush_batch_size: int = 100
+    conversation_cache_ttl: int = 3600
+    stream_responses: bool = True
+    stream_edit_interval: float = 1.5
+    debounce_interval: float = 1.5
+    requests_per_minute: int = 500
+    tokens_per_minute: int = 300000
+    max_concurrent_requests: int = 8
+    rate_limits: Dict[str, List[int]] = field(default_factory=dict)
+    tokenizer_pool: str = "process"
+    tokenizer_workers: int = 2
+    inline_tokenize_threshold: int = 65536
+    summarize_conversations: bool = False
+    summary_model: str = "gpt-3.5-turbo-0125"
+    summary_threshold_tokens: int = 8000
+    summary_keep_tokens: int = 3000
+    example_token_budget: int = 1000
+    response_cache_enabled: bool = False
+    response_cache_max_temperature: float = 0.2
+    response_cache_size: int = 512
+    response_cache_max_rows: int = 10000
+    response_cache_ttl: int = 604800
+    run_poll_initial_interval: float = 0.5
+    run_poll_max_interval: float = 8.0
+    run_poll_backoff: float = 1.5
+    run_timeout: int = 300
+    http_connection_limit: int = 20
+    max_attachment_size: int = 26214400
+    max_total_attachment_size: int = 52428800
+    attachment_spool_size: int = 1048576
+    file_cache_ttl: int = 604800
+    file_cache_gc_interval: int = 3600
+    digest_threshold_tokens: int = 8000
+    digest_chunk_tokens: int = 3000
+    digest_concurrency: int = 4
+    response_file_threshold: int = 8000
+
+
+@dataclass(frozen=True)
+class PromptPrefix:
+    messages: List[dict[str, str]]
+    tokens: int
+
+
+class MessageRoute(Enum):
+    IGNORE = 0
+    START_CHAT = 1
+    CLOSE_CHAT = 2
+    RESTART_CHAT = 3
+    COMPLETION = 4
 
 
 class OpenAIResult(Enum):
@@ -158,6 +301,7 @@ class OpenAIResult(Enum):
     TOO_LONG = 1
     INVALID_REQUEST = 2
     OTHER_ERROR = 3
+    RATE_LIMITED = 4
 
 
 @dataclass
@@ -167,6 +311,7 @@ class OpenAIResponse:
     completion_tokens: Optional[int]
     reply_text: Optional[str]
     status_text: Optional[str]
+    delivered: bool = False
 
 
 class RunResult(Enum):
@@ -181,68 +326,3 @@ class RunResult(Enum):
 class RunResponse:
     status: RunResult
     messages: List[Messages]
-
-
-@dataclass
-class QueueableList(list):
-    def __init__(self, *args, callback=None):
-        super().__init__(*args)
-        self.callback = callback
-
-    def append(self, item):
-        super().append(item)
-        if self.callback:
-            self.callback()
-
-    def extend(self, iterable):
-        super().extend(iterable)
-        if self.callback:
-            self.callback()
-
-    def insert(self, index, item):
-        super().insert(index, item)
-        if self.callback:
-            self.callback()
-
-    def remove(self, item):
-        super().remove(item)
-        if self.callback:
-            self.callback()
-
-    def pop(self, index=-1):
-        item = super().pop(index)
-        if self.callback:
-            self.callback()
-        return item
-
-    def __delitem__(self, index):
-        super().__delitem__(index)
-        if self.callback:
-            self.callback()
-
-    def __setitem__(self, index, item):
-        super().__setitem__(index, item)
-        if self.callback:
-            self.callback()
-
-
-@dataclass
-class QueueableDict(dict):
-    def __init__(self, *args, callback=None, **kwargs):
-        self.callback = callback
-        super().__init__(*args, **kwargs)
-
-    def __setitem__(self, key, value):
-        super().__setitem__(key, value)
-        if self.callback:
-            self.callback()
-
-    def __delitem__(self, key):
-        super().__delitem__(key)
-        if self.callback:
-            self.callback()
-
-    def update(self, *args, **kwargs):
-        super().update(*args, **kwargs)
-        if self.callback:
-            self.callback()
@@ -3,7 +3,7 @@ from pathlib import Path
 
 import yaml
 
-from storage.classes import Configuration
+from storage.classes import Configuration, GPTConversation, GPTMessage
 
 _configuration = Configuration()
 
@@ -16,6 +16,11 @@ def write_config(config: Configuration):
 def read_config() -> Configuration:
     with open("config/config.yml", 'r') as file:
         data = yaml.safe_load(file)
+    if "example_conversations" in data:
+        data["example_conversations"] = [
+            GPTConversation([GPTMessage(**message) for message in conversation["messages"]])
+            for conversation in data["example_conversations"]
+        ]
     return Configuration(**data)
 
 
@@ -1,107 +1,436 @@
+import asyncio
 import base64
 import pickle
 import sqlite3
+import time
+from datetime import datetime, timezone
 
 import discord
 
 from storage.classes import *
+from storage.confighelper import get_config
+from storage.writebehind import WriteBehindWriter
 
+DATABASE_PATH = 'database.db'
+SCHEMA_VERSION = 1
 
-def save():
-    conn = sqlite3.connect('database.db')
-    c = conn.cursor()
+_writer: Optional[WriteBehindWriter] = None
 
-    c.execute('DELETE FROM gpt_users')
-    c.execute('DELETE FROM requests')
 
-    for gpt_user in _gpt_users:
-        obj_base64 = base64.b64encode(pickle.dumps(gpt_user)).decode('utf-8')
-        c.execute('INSERT INTO gpt_users (id, object) VALUES (?,?)', (gpt_user.id, obj_base64))
+def save_user(gpt_user: GPTUser):
+    _writer.upsert(('gpt_user', gpt_user.id), lambda c: write_user_row(c, gpt_user))
 
-    # Save requests
-    for user_id, requests in _requests_map.items():
-        obj_base64 = base64.b64encode(pickle.dumps(requests)).decode('utf-8')
-        c.execute('INSERT INTO requests (id, object) VALUES (?,?)', (user_id, obj_base64))
 
-    conn.commit()
-    conn.close()
+def save_request(user_id: int, request: GPTRequest):
+    _writer.append(lambda c: write_request_rows(c, user_id, request))
+
+
+def delete_user(user_id: int):
+    _writer.upsert(('gpt_user', user_id), lambda c: delete_user_row(c, user_id))
+
+
+def write_user_row(c: sqlite3.Cursor, gpt_user: GPTUser):
+    gpt_channel = gpt_user.gpt_channel
+    c.execute('''INSERT OR REPLACE INTO users
+                 (id, chats, currently_chatting, channel_id, model, max_tokens, temperature)
+                 VALUES (?,?,?,?,?,?,?)''',
+              (gpt_user.id, gpt_user.chats, int(gpt_user.currently_chatting), gpt_channel.id,
+               gpt_channel.current_model.model_name(), gpt_channel.current_max_tokens,
+               gpt_channel.current_temperature))
+
+
+def delete_user_row(c: sqlite3.Cursor, user_id: int):
+    c.execute('DELETE FROM users WHERE id = ?', (user_id,))
+
+
+def write_request_rows(c: sqlite3.Cursor, user_id: int, request: GPTRequest):
+    insert_ledger_row(c, user_id, request)
+    for period in billing_periods(request.timestamp):
+        c.execute('''INSERT INTO billing_rollups
+                     (user_id, model, period, requests, input_tokens, output_tokens, cost)
+                     VALUES (?,?,?,1,?,?,?)
+                     ON CONFLICT (user_id, model, period) DO UPDATE SET
+                     requests = requests + 1,
+                     input_tokens = input_tokens + excluded.input_tokens,
+                     output_tokens = output_tokens + excluded.output_tokens,
+                     cost = cost + excluded.cost''',
+                  (user_id, request.model.model_name(), period, request.input_tokens,
+                   request.output_tokens, request.cost()))
+
+
+def insert_ledger_row(c: sqlite3.Cursor, user_id: int, request: GPTRequest):
+    c.execute('''INSERT INTO request_ledger
+                 (user_id, channel_id, model, input_tokens, output_tokens, cost, created_at)
+                 VALUES (?,?,?,?,?,?,?)''',
+              (user_id, request.channel_id, request.model.model_name(), request.input_tokens,
+               request.output_tokens, request.cost(), request.timestamp))
 
 
 def test():
     print("test")
 
 
-_gpt_users: QueueableList[GPTUser] = QueueableList(callback=save)
-_requests_map: QueueableDict[int, List[GPTRequest]] = QueueableDict(callback=save)
+_gpt_users: dict[int, GPTUser] = {}
+_gpt_users_by_channel: dict[int, GPTUser] = {}
+# Keyed by (user id, model name, period); only the "all" and current month periods are kept in memory.
+_billing_rollups: dict[tuple[int, str, str], BillingTotals] = {}
 
 
 def setup_database():
-    conn = sqlite3.connect('database.db')
-    setup_gpt_users(conn)
-    setup_requests(conn)
+    global _writer
+    conn = sqlite3.connect(DATABASE_PATH)
+    conn.execute('PRAGMA journal_mode=WAL')
+    setup_users(conn)
+    setup_request_ledger(conn)
+    migrate_pickled_users(conn)
     load_gpt_users(conn)
-    load_requests(conn)
+    setup_billing_rollups(conn)
+    migrate_pickled_requests(conn)
+    load_billing_rollups(conn)
+    setup_response_cache(conn)
+    setup_assistants(conn)
+    setup_file_cache(conn)
+    setup_attachment_digests(conn)
+    conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
     conn.close()
+    _writer = WriteBehindWriter(
+        DATABASE_PATH,
+        interval=get_config().database_flush_interval,
+        batch_size=get_config().database_flush_batch_size
+    )
+    _writer.start()
 
 
-def setup_gpt_users(conn: sqlite3.Connection):
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS gpt_users
-                 (id INTEGER PRIMARY KEY,  object TEXT)''')
-    conn.commit()
+def close_database():
+    if _writer is not None:
+        _writer.close()
 
 
-def setup_requests(conn: sqlite3.Connection):
+def setup_users(conn: sqlite3.Connection):
     c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS requests
-                 (id INTEGER PRIMARY KEY,  object TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                 (id INTEGER PRIMARY KEY, chats INTEGER NOT NULL, currently_chatting INTEGER NOT NULL,
+                  channel_id INTEGER NOT NULL, model TEXT NOT NULL, max_tokens INTEGER NOT NULL,
+                  temperature REAL NOT NULL)''')
     conn.commit()
 
 
-def load_gpt_users(conn: sqlite3.Connection) -> None:
-    global _gpt_users
+def migrate_pickled_users(conn: sqlite3.Connection) -> None:
+    # Older databases stored each user as a base64 encoded pickle.
     c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'gpt_users'")
+    if c.fetchone() is None:
+        return
     c.execute('SELECT * FROM gpt_users')
     rows = c.fetchall()
+    failed = 0
     for row in rows:
-        obj_base64 = row[1]
-        obj = pickle.loads(base64.b64decode(obj_base64))
-        _gpt_users.append(obj)
+        try:
+            write_user_row(c, pickle.loads(base64.b64decode(row[1])))
+        except Exception as e:
+            failed += 1
+            print(f"Failed to migrate user {row[0]}\n{type(e).__name__}: {e}")
+    # Keep the legacy table if anything could not be read, so no user is lost; it is retried on the next start.
+    if failed == 0:
+        c.execute('DROP TABLE gpt_users')
+    conn.commit()
 
 
-def load_requests(conn: sqlite3.Connection) -> None:
-    global _requests_map
+def setup_request_ledger(conn: sqlite3.Connection):
     c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS request_ledger
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, channel_id INTEGER NOT NULL,
+                  model TEXT NOT NULL, input_tokens INTEGER NOT NULL, output_tokens INTEGER NOT NULL,
+                  cost REAL NOT NULL, created_at REAL NOT NULL)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_request_ledger_user_time ON request_ledger (user_id, created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_request_ledger_model_time ON request_ledger (model, created_at)')
+    conn.commit()
+
+
+def setup_response_cache(conn: sqlite3.Connection):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS response_cache
+                 (key TEXT PRIMARY KEY, reply TEXT NOT NULL, created_at REAL NOT NULL)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_time ON response_cache (created_at)')
+    prune_response_cache(c)
+    conn.commit()
+
+
+def prune_response_cache(c: sqlite3.Cursor):
+    c.execute('DELETE FROM response_cache WHERE created_at < ?', (time.time() - get_config().response_cache_ttl,))
+    c.execute('''DELETE FROM response_cache WHERE key NOT IN
+                 (SELECT key FROM response_cache ORDER BY created_at DESC LIMIT ?)''',
+              (get_config().response_cache_max_rows,))
+
+
+def setup_assistants(conn: sqlite3.Connection):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS assistants
+                 (model TEXT NOT NULL, instructions TEXT NOT NULL, assistant_id TEXT NOT NULL,
+                  created_at REAL NOT NULL, PRIMARY KEY (model, instructions))''')
+    conn.commit()
+
+
+def setup_file_cache(conn: sqlite3.Connection):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS file_cache
+                 (sha256 TEXT PRIMARY KEY, file_id TEXT NOT NULL, tokens INTEGER NOT NULL, encoding TEXT NOT NULL,
+                  refcount INTEGER NOT NULL, last_used REAL NOT NULL)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_file_cache_last_used ON file_cache (last_used)')
+    # Runs that were holding a file did not survive the restart.
+    c.execute('UPDATE file_cache SET refcount = 0')
+    conn.commit()
+
+
+def setup_attachment_digests(conn: sqlite3.Connection):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS attachment_digests
+                 (sha256 TEXT NOT NULL, model TEXT NOT NULL, digest TEXT NOT NULL, created_at REAL NOT NULL,
+                  PRIMARY KEY (sha256, model))''')
+    c.execute('DELETE FROM attachment_digests WHERE created_at < ?', (time.time() - get_config().file_cache_ttl,))
+    conn.commit()
+
+
+def setup_billing_rollups(conn: sqlite3.Connection):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS billing_rollups
+                 (user_id INTEGER NOT NULL, model TEXT NOT NULL, period TEXT NOT NULL,
+                  requests INTEGER NOT NULL, input_tokens INTEGER NOT NULL, output_tokens INTEGER NOT NULL,
+                  cost REAL NOT NULL, PRIMARY KEY (user_id, model, period))''')
+    c.execute('SELECT COUNT(*) FROM billing_rollups')
+    if c.fetchone()[0] == 0:
+        # Backfill from the ledger the first time rollups are enabled.
+        for period in ["'all'",
+                       "strftime('%Y-%m', created_at, 'unixepoch')",
+                       "strftime('%Y-%m-%d', created_at, 'unixepoch')"]:
+            c.execute(f'''INSERT INTO billing_rollups
+                          SELECT user_id, model, {period}, COUNT(*), SUM(input_tokens), SUM(output_tokens), SUM(cost)
+                          FROM request_ledger GROUP BY user_id, model, {period}''')
+    conn.commit()
+
+
+def load_billing_rollups(conn: sqlite3.Connection) -> None:
+    c = conn.cursor()
+    c.execute('''SELECT user_id, model, period, requests, input_tokens, output_tokens, cost
+                 FROM billing_rollups WHERE period IN (?, ?)''', billing_periods(time.time())[:2])
+    rows = c.fetchall()
+    for row in rows:
+        model = Model.from_model_name(row[1])
+        if model is None:
+            continue
+        _billing_rollups[(row[0], row[1], row[2])] = BillingTotals(
+            model=model,
+            requests=row[3],
+            input_tokens=row[4],
+            output_tokens=row[5],
+            cost=row[6]
+        )
+
+
+def migrate_pickled_requests(conn: sqlite3.Connection) -> None:
+    # Older databases stored each user's whole request list as one pickled row.
+    c = conn.cursor()
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'requests'")
+    if c.fetchone() is None:
+        return
+    channels = {user_id: gpt_user.gpt_channel.id for user_id, gpt_user in _gpt_users.items()}
     c.execute('SELECT * FROM requests')
     rows = c.fetchall()
+    failed = 0
     for row in rows:
-        obj_base64 = row[1]
-        obj = pickle.loads(base64.b64decode(obj_base64))
-        _requests_map[row[0]] = obj
+        try:
+            requests = pickle.loads(base64.b64decode(row[1]))
+        except Exception as e:
+            failed += 1
+            print(f"Failed to migrate requests of user {row[0]}\n{type(e).__name__}: {e}")
+            continue
+        # Rollups already exist at this point, so migrated requests are added to them like new ones.
+        for request in requests:
+            write_request_rows(c, row[0], GPTRequest(
+                model=request.model,
+                input_tokens=request.input_tokens,
+                output_tokens=request.output_tokens,
+                channel_id=channels.get(row[0], 0),
+                timestamp=getattr(request, 'timestamp', 0.0)
+            ))
+        # Migrated rows are removed so a retry after a partial failure does not count them twice.
+        c.execute('DELETE FROM requests WHERE id = ?', (row[0],))
+    if failed == 0:
+        c.execute('DROP TABLE requests')
+    conn.commit()
+
+
+def load_gpt_users(conn: sqlite3.Connection) -> None:
+    c = conn.cursor()
+    c.execute('SELECT id, chats, currently_chatting, channel_id, model, max_tokens, temperature FROM users')
+    rows = c.fetchall()
+    for row in rows:
+        index_user(GPTUser(
+            id=row[0],
+            chats=row[1],
+            currently_chatting=bool(row[2]),
+            gpt_channel=GPTChannel(
+                id=row[3],
+                current_model=Model.from_model_name(row[4]) or Model.GPT_4_TURBO,
+                current_max_tokens=row[5],
+                current_temperature=row[6]
+            )
+        ))
 
 
 def add_user(user: discord.User, channel: discord.TextChannel):
     gpt_user = GPTUser(user.id, 0, False, GPTChannel(
         id=channel.id
     ))
-    _gpt_users.append(gpt_user)
+    previous = _gpt_users.get(gpt_user.id)
+    if previous is not None:
+        unindex_user(previous)
+    index_user(gpt_user)
+    save_user(gpt_user)
 
 
 def add_request(user: GPTUser, request: GPTRequest):
-    if user.id in _requests_map:
-        _requests_map[user.id].append(request)
-        _requests_map[user.id] = _requests_map[user.id]
-    else:
-        _requests_map[user.id] = [request]
+    for period in billing_periods(request.timestamp)[:2]:
+        key = (user.id, request.model.model_name(), period)
+        if key not in _billing_rollups:
+            _billing_rollups[key] = BillingTotals(model=request.model)
+        _billing_rollups[key].add(request)
+    save_request(user.id, request)
 
 
 def remove_user(user: GPTUser):
-    _gpt_users.remove(user)
+    unindex_user(user)
+    delete_user(user.id)
+
+
+def index_user(gpt_user: GPTUser):
+    _gpt_users[gpt_user.id] = gpt_user
+    _gpt_users_by_channel[gpt_user.gpt_channel.id] = gpt_user
+
+
+def unindex_user(gpt_user: GPTUser):
+    _gpt_users.pop(gpt_user.id, None)
+    if _gpt_users_by_channel.get(gpt_user.gpt_channel.id) is gpt_user:
+        del _gpt_users_by_channel[gpt_user.gpt_channel.id]
 
 
 def get_gpt_users() -> List[GPTUser]:
-    return _gpt_users
+    return list(_gpt_users.values())
+
+
+def get_gpt_user(user_id: int, channel_id: int) -> Optional[GPTUser]:
+    gpt_user = _gpt_users.get(user_id)
+    if gpt_user is None or gpt_user.gpt_channel.id != channel_id:
+        return None
+    return gpt_user
+
+
+def get_gpt_user_by_id(user_id: int) -> Optional[GPTUser]:
+    return _gpt_users.get(user_id)
+
+
+def is_provisioned_channel(channel_id: int) -> bool:
+    return channel_id in _gpt_users_by_channel
+
+
+def save_cached_response(key: str, reply: str, created_at: float):
+    _writer.upsert(('response_cache', key), lambda c: c.execute(
+        'INSERT OR REPLACE INTO response_cache (key, reply, created_at) VALUES (?,?,?)', (key, reply, created_at)))
+    _writer.upsert(('response_cache_prune',), prune_response_cache)
+
+
+def load_cached_response(key: str) -> Optional[tuple[str, float]]:
+    conn = sqlite3.connect(DATABASE_PATH)
+    c = conn.cursor()
+    c.execute('SELECT reply, created_at FROM response_cache WHERE key = ?', (key,))
+    row = c.fetchone()
+    conn.close()
+    return row
+
+
+def billing_periods(timestamp: float) -> List[str]:
+    date = datetime.fromtimestamp(timestamp, tz=timezone.utc)
+    return ['all', date.strftime('%Y-%m'), date.strftime('%Y-%m-%d')]
+
+
+def get_billing_totals(user_id: int, period: str = 'all') -> List[BillingTotals]:
+    totals = []
+    for model in Model:
+        total = _billing_rollups.get((user_id, model.model_name(), period))
+        if total is not None:
+            totals.append(total)
+    return totals
+
+
+def save_assistant(model_name: str, instructions: str, assistant_id: str):
+    _writer.upsert(('assistant', model_name, instructions), lambda c: c.execute(
+        'INSERT OR REPLACE INTO assistants (model, instructions, assistant_id, created_at) VALUES (?,?,?,?)',
+        (model_name, instructions, assistant_id, time.time())))
+
 
+def delete_assistant(model_name: str, instructions: str):
+    _writer.upsert(('assistant', model_name, instructions), lambda c: c.execute(
+        'DELETE FROM assistants WHERE model = ? AND instructions = ?', (model_name, instructions)))
 
-def get_requests() -> dict[int, List[GPTRequest]]:
-    return _requests_map
+
+async def run_database_read(function, *args):
+    # Reads open their own connection and may flush pending writes first, so they run off the event loop.
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+def load_assistants(model_name: str) -> dict[str, str]:
+    # Maps the instructions hash to the assistant id for every assistant created for this model.
+    _writer.flush()
+    conn = sqlite3.connect(DATABASE_PATH)
+    c = conn.cursor()
+    c.execute('SELECT instructions, assistant_id FROM assistants WHERE model = ?', (model_name,))
+    rows = c.fetchall()
+    conn.close()
+    return {row[0]: row[1] for row in rows}
+
+
+def save_cached_file(cached: CachedFile):
+    _writer.upsert(('file_cache', cached.sha256), lambda c: c.execute(
+        '''INSERT OR REPLACE INTO file_cache (sha256, file_id, tokens, encoding, refcount, last_used)
+           VALUES (?,?,?,?,?,?)''',
+        (cached.sha256, cached.file_id, cached.tokens, cached.encoding, cached.refcount, cached.last_used)))
+
+
+def delete_cached_file(sha256: str):
+    _writer.upsert(('file_cache', sha256), lambda c: c.execute('DELETE FROM file_cache WHERE sha256 = ?', (sha256,)))
+
+
+def load_cached_file(sha256: str) -> Optional[CachedFile]:
+    conn = sqlite3.connect(DATABASE_PATH)
+    c = conn.cursor()
+    c.execute('''SELECT sha256, file_id, tokens, encoding, refcount, last_used
+                 FROM file_cache WHERE sha256 = ?''', (sha256,))
+    row = c.fetchone()
+    conn.close()
+    return CachedFile(*row) if row is not None else None
+
+
+def load_expired_files(before: float) -> List[CachedFile]:
+    _writer.flush()
+    conn = sqlite3.connect(DATABASE_PATH)
+    c = conn.cursor()
+    c.execute('''SELECT sha256, file_id, tokens, encoding, refcount, last_used
+                 FROM file_cache WHERE refcount = 0 AND last_used < ?''', (before,))
+    rows = c.fetchall()
+    conn.close()
+    return [CachedFile(*row) for row in rows]
+
+
+def save_attachment_digest(sha256: str, model_name: str, digest: str):
+    _writer.upsert(('attachment_digest', sha256, model_name), lambda c: c.execute(
+        'INSERT OR REPLACE INTO attachment_digests (sha256, model, digest, created_at) VALUES (?,?,?,?)',
+        (sha256, model_name, digest, time.time())))
+
+
+def load_attachment_digest(sha256: str, model_name: str) -> Optional[str]:
+    conn = sqlite3.connect(DATABASE_PATH)
+    c = conn.cursor()
+    c.execute('SELECT digest FROM attachment_digests WHERE sha256 = ? AND model = ?', (sha256, model_name))
+    row = c.fetchone()
+    conn.close()
+    return row[0] if row is not None else None
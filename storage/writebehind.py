@@ -0,0 +1,107 @@
+import sqlite3
+import threading
+from typing import Callable, Dict, Hashable, List
+
+WriteOperation = Callable[[sqlite3.Cursor], None]
+MAX_ATTEMPTS = 5
+
+
+class WriteBehindWriter:
+    def __init__(self, path: str, interval: float, batch_size: int) -> None:
+        self.path = path
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending: Dict[Hashable, WriteOperation] = {}
+        self._appends: List[WriteOperation] = []
+        self._failures: Dict[WriteOperation, int] = {}
+        self._pending_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._thread = threading.Thread(target=self._run, name="database-writer", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def upsert(self, key: Hashable, operation: WriteOperation) -> None:
+        # Later writes for the same key replace earlier ones that have not been flushed yet.
+        with self._pending_lock:
+            self._pending[key] = operation
+            size = len(self._pending) + len(self._appends)
+        if size >= self.batch_size:
+            self._wake.set()
+
+    def append(self, operation: WriteOperation) -> None:
+        with self._pending_lock:
+            self._appends.append(operation)
+            size = len(self._pending) + len(self._appends)
+        if size >= self.batch_size:
+            self._wake.set()
+
+    def flush(self) -> None:
+        # The swap and the write happen under one lock so batches always commit in the order they were taken.
+        with self._write_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+                appends, self._appends = self._appends, []
+            if not pending and not appends:
+                return
+            operations = list(pending.items()) + [(None, operation) for operation in appends]
+            c = self._conn.cursor()
+            try:
+                for _, operation in operations:
+                    operation(c)
+                self._conn.commit()
+                return
+            except sqlite3.Error as e:
+                self._conn.rollback()
+                print(f"Failed to flush database writes, retrying one by one\n{type(e).__name__}: {e}")
+            # Run the batch one write at a time so a single bad write does not take the rest with it.
+            retry: List[tuple[Hashable, WriteOperation]] = []
+            for key, operation in operations:
+                try:
+                    operation(c)
+                    self._conn.commit()
+                    self._failures.pop(operation, None)
+                except sqlite3.OperationalError as e:
+                    # Locked or busy databases and I/O errors are usually transient, so the write is retried later.
+                    self._conn.rollback()
+                    attempts = self._failures.get(operation, 0) + 1
+                    if attempts < MAX_ATTEMPTS:
+                        self._failures[operation] = attempts
+                        retry.append((key, operation))
+                        print(f"Deferred database write\n{type(e).__name__}: {e}")
+                    else:
+                        self._failures.pop(operation, None)
+                        print(f"Dropped database write after {attempts} attempts\n{type(e).__name__}: {e}")
+                except sqlite3.Error as e:
+                    self._conn.rollback()
+                    self._failures.pop(operation, None)
+                    print(f"Dropped database write\n{type(e).__name__}: {e}")
+            if retry:
+                self._requeue(retry)
+
+    def _requeue(self, operations: List[tuple[Hashable, WriteOperation]]) -> None:
+        with self._pending_lock:
+            # Anything written for the same key since the swap is newer and wins.
+            pending = {key: operation for key, operation in operations if key is not None}
+            pending.update(self._pending)
+            self._pending = pending
+            self._appends = [operation for key, operation in operations if key is None] + self._appends
+
+    def close(self) -> None:
+        if self._stopping:
+            return
+        self._stopping = True
+        self._wake.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.flush()
+        self._conn.close()
+
+    def _run(self) -> None:
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
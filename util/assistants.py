@@ -0,0 +1,80 @@
+import asyncio
+import hashlib
+from typing import Awaitable, Callable, Dict, Optional
+
+import openai
+
+from storage.classes import Model
+from storage.confighelper import get_config
+from storage.databasehelper import save_assistant, delete_assistant, load_assistants, run_database_read
+from util.gptapi import get_api
+from util.singleflight import get_single_flight
+
+_assistants: Dict[str, str] = {}
+_cleanup: Optional[asyncio.Queue] = None
+_cleanup_task: Optional[asyncio.Task] = None
+
+
+def instructions_hash() -> str:
+    return hashlib.sha256(get_config().instructions.encode('utf-8')).hexdigest()
+
+
+async def get_assistant_id(model: Model) -> str:
+    # One long-lived assistant per model and instructions; files are attached to the thread instead.
+    model_name = model.model_name()
+    assistant_id = _assistants.get(model_name)
+    if assistant_id is not None:
+        return assistant_id
+    assistant_id, _ = await get_single_flight().do(("assistant", model_name), lambda: create_assistant(model))
+    return assistant_id
+
+
+async def create_assistant(model: Model) -> str:
+    model_name = model.model_name()
+    current = instructions_hash()
+    existing = await run_database_read(load_assistants, model_name)
+    for instructions, stale_id in existing.items():
+        if instructions != current:
+            # The instructions changed since this one was created, so it is never used again.
+            delete_assistant(model_name, instructions)
+            schedule_cleanup(lambda api, stale_id=stale_id: api.beta.assistants.delete(stale_id))
+    assistant_id = existing.get(current)
+    if assistant_id is None:
+        api = await get_api()
+        assistant = await api.beta.assistants.create(
+            name=f'GPTHelper - {model_name}',
+            instructions=get_config().instructions,
+            tools=[{"type": "retrieval"}, {"type": "code_interpreter"}],
+            model=model_name
+        )
+        assistant_id = assistant.id
+        save_assistant(model_name, current, assistant_id)
+    _assistants[model_name] = assistant_id
+    return assistant_id
+
+
+def forget_assistant(model: Model) -> None:
+    # Called when the API no longer knows the cached id, e.g. it was deleted from the dashboard.
+    _assistants.pop(model.model_name(), None)
+    delete_assistant(model.model_name(), instructions_hash())
+
+
+def schedule_cleanup(action: Callable[[openai.AsyncOpenAI], Awaitable]) -> None:
+    global _cleanup, _cleanup_task
+    if _cleanup is None:
+        _cleanup = asyncio.Queue()
+    if _cleanup_task is None or _cleanup_task.done():
+        _cleanup_task = asyncio.create_task(run_cleanup())
+    _cleanup.put_nowait(action)
+
+
+async def run_cleanup() -> None:
+    api = await get_api()
+    while True:
+        action = await _cleanup.get()
+        try:
+            await action(api)
+        except openai.NotFoundError:
+            pass
+        except Exception as e:
+            print(f"Failed to clean up Assistants resource\n{type(e).__name__}: {e}")
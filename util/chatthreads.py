@@ -0,0 +1,25 @@
+from typing import Set
+
+import discord
+
+CHAT_THREAD_PREFIX = "GPT Chat - "
+
+# Ids of open chat threads created by the bot, so most messages can be routed without inspecting the thread.
+_chat_threads: Set[int] = set()
+
+
+def add_chat_thread(thread_id: int) -> None:
+    _chat_threads.add(thread_id)
+
+
+def remove_chat_thread(thread_id: int) -> None:
+    _chat_threads.discard(thread_id)
+
+
+def is_chat_thread(thread_id: int) -> bool:
+    return thread_id in _chat_threads
+
+
+def is_open_chat_thread(thread: discord.Thread, bot_user_id: int) -> bool:
+    return thread.owner_id == bot_user_id and not thread.archived and not thread.locked \
+        and thread.name.startswith(CHAT_THREAD_PREFIX)
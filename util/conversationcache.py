@@ -0,0 +1,131 @@
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import discord
+
+from storage.classes import GPTMessage
+from storage.confighelper import get_config
+
+HISTORY_LIMIT = 200
+
+
+class ThreadConversation:
+    def __init__(self, thread_id: int) -> None:
+        self.thread_id = thread_id
+        self.messages: Deque[Tuple[int, GPTMessage]] = deque(maxlen=HISTORY_LIMIT)
+        self.message_count = 0
+        self.last_message_id = 0
+        self.last_active = time.monotonic()
+        self.summary: Optional[str] = None
+        self.summary_until = 0
+        # Digests of large text attachments, keyed by file hash, so later turns can still refer to the files.
+        self.attachments: Dict[str, GPTMessage] = {}
+        # Full text of replies that were sent as a file, keyed by message id, since their content is only the notice.
+        self.replies: Dict[int, str] = {}
+
+    def record(self, message: discord.Message) -> None:
+        # Snowflakes are monotonic, so anything at or below the newest id has already been seen.
+        if message.id <= self.last_message_id:
+            return
+        self.last_message_id = message.id
+        self.message_count += 1
+        self.last_active = time.monotonic()
+        text = self.replies.get(message.id, message.content)
+        if text:
+            self.messages.append((message.id, GPTMessage(user=message.author.name, text=text)))
+
+    def update(self, message: discord.Message) -> None:
+        for index, (message_id, _) in enumerate(self.messages):
+            if message_id == message.id:
+                text = self.replies.get(message.id, message.content)
+                if text:
+                    self.messages[index] = (message_id, GPTMessage(user=message.author.name, text=text))
+                else:
+                    del self.messages[index]
+                return
+
+    def record_reply(self, message_id: int, text: str) -> None:
+        self.replies[message_id] = text
+        while len(self.replies) > HISTORY_LIMIT:
+            del self.replies[next(iter(self.replies))]
+        for index, (cached_id, message) in enumerate(self.messages):
+            if cached_id == message_id:
+                self.messages[index] = (message_id, GPTMessage(user=message.user, text=text))
+                break
+
+    def remove(self, message_id: int) -> None:
+        for index, (cached_id, _) in enumerate(self.messages):
+            if cached_id == message_id:
+                del self.messages[index]
+                break
+        self.replies.pop(message_id, None)
+        self.message_count = max(0, self.message_count - 1)
+
+    def gpt_messages(self) -> List[GPTMessage]:
+        return [message for _, message in self.messages]
+
+
+_conversations: Dict[int, ThreadConversation] = {}
+_seeding: Dict[int, asyncio.Task] = {}
+
+
+async def get_conversation(thread: discord.Thread) -> ThreadConversation:
+    evict_idle_conversations()
+    conversation = _conversations.get(thread.id)
+    if conversation is not None:
+        conversation.last_active = time.monotonic()
+        return conversation
+    # Concurrent callers share one history fetch per thread.
+    task = _seeding.get(thread.id)
+    if task is None:
+        task = asyncio.create_task(seed_conversation(thread))
+        _seeding[thread.id] = task
+    return await asyncio.shield(task)
+
+
+async def seed_conversation(thread: discord.Thread) -> ThreadConversation:
+    try:
+        conversation = ThreadConversation(thread.id)
+        async for message in thread.history(limit=None, oldest_first=True):
+            conversation.record(message)
+        _conversations[thread.id] = conversation
+        return conversation
+    finally:
+        _seeding.pop(thread.id, None)
+
+
+def record_message(message: discord.Message) -> None:
+    conversation = _conversations.get(message.channel.id)
+    if conversation is not None:
+        conversation.record(message)
+
+
+def update_message(message: discord.Message) -> None:
+    conversation = _conversations.get(message.channel.id)
+    if conversation is not None:
+        conversation.update(message)
+
+
+def record_reply(channel_id: int, message_id: int, text: str) -> None:
+    conversation = _conversations.get(channel_id)
+    if conversation is not None:
+        conversation.record_reply(message_id, text)
+
+
+def remove_message(channel_id: int, message_id: int) -> None:
+    conversation = _conversations.get(channel_id)
+    if conversation is not None:
+        conversation.remove(message_id)
+
+
+def evict_conversation(thread_id: int) -> None:
+    _conversations.pop(thread_id, None)
+
+
+def evict_idle_conversations() -> None:
+    cutoff = time.monotonic() - get_config().conversation_cache_ttl
+    for thread_id in [thread_id for thread_id, conversation in _conversations.items()
+                      if conversation.last_active < cutoff]:
+        del _conversations[thread_id]
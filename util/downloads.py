@@ -0,0 +1,84 @@
+import asyncio
+import hashlib
+import tempfile
+from typing import List, Optional, IO
+
+import aiohttp
+import discord
+
+from storage.confighelper import get_config
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Download:
+    def __init__(self, attachment: discord.Attachment) -> None:
+        self.attachment = attachment
+        # Small files stay in memory; anything larger than the spool size is written to disk as it arrives.
+        self.file: IO[bytes] = tempfile.SpooledTemporaryFile(max_size=get_config().attachment_spool_size)
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes) -> None:
+        self.file.write(chunk)
+        self.digest.update(chunk)
+        self.size += len(chunk)
+
+    def sha256(self) -> str:
+        return self.digest.hexdigest()
+
+    def rewind(self) -> IO[bytes]:
+        self.file.seek(0)
+        return self.file
+
+    def read(self) -> bytes:
+        return self.rewind().read()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def create_http_session() -> aiohttp.ClientSession:
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=get_config().http_connection_limit),
+        timeout=aiohttp.ClientTimeout(total=None, sock_read=get_config().timeout)
+    )
+
+
+async def download_attachments(session: aiohttp.ClientSession,
+                               attachments: List[discord.Attachment]) -> List[Optional[Download]]:
+    # Attachments over the per-file limit or past the total budget are skipped, then the rest download together.
+    budget = get_config().max_total_attachment_size
+    allowed = []
+    for attachment in attachments:
+        fits = attachment.size <= min(budget, get_config().max_attachment_size)
+        if fits:
+            budget -= attachment.size
+        allowed.append(fits)
+    return list(await asyncio.gather(*(
+        download_attachment(session, attachment) if fits else skip_attachment()
+        for attachment, fits in zip(attachments, allowed)
+    )))
+
+
+async def skip_attachment() -> None:
+    return None
+
+
+async def download_attachment(session: aiohttp.ClientSession, attachment: discord.Attachment) -> Optional[Download]:
+    download = Download(attachment)
+    try:
+        async with session.get(attachment.url) as resp:
+            if resp.status != 200:
+                download.close()
+                return None
+            async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                download.write(chunk)
+                if download.size > get_config().max_attachment_size:
+                    download.close()
+                    return None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Failed to download {attachment.filename}\n{type(e).__name__}: {e}")
+        download.close()
+        return None
+    return download
@@ -0,0 +1,81 @@
+import asyncio
+import time
+from typing import Dict, Optional
+
+from storage.classes import CachedFile, Model
+from storage.confighelper import get_config
+from storage.databasehelper import save_cached_file, delete_cached_file, load_cached_file, load_expired_files, \
+    run_database_read
+from util.assistants import schedule_cleanup
+from util.downloads import Download
+from util.gptapi import get_api
+from util.singleflight import get_single_flight
+from util.tokens import get_encoding, num_tokens_from_file_async
+
+# Files seen since startup, keyed by the SHA-256 of their content; expired ones are dropped by the GC.
+_files: Dict[str, CachedFile] = {}
+_gc_task: Optional[asyncio.Task] = None
+
+
+async def acquire_file(download: Download, model: Model) -> CachedFile:
+    # A file seen before is neither uploaded nor tokenized again; callers must release it once the run is done.
+    cached, _ = await get_single_flight().do(("file", download.sha256()), lambda: lookup_file(download, model))
+    cached.refcount += 1
+    cached.last_used = time.time()
+    _files[cached.sha256] = cached
+    save_cached_file(cached)
+    return cached
+
+
+async def lookup_file(download: Download, model: Model) -> CachedFile:
+    sha256 = download.sha256()
+    cached = _files.get(sha256) or await run_database_read(load_cached_file, sha256)
+    encoding = get_encoding(model).name
+    if cached is None:
+        api = await get_api()
+        tokens = await num_tokens_from_file_async(download.file, model)
+        response = await api.files.create(file=(download.attachment.filename, download.rewind()),
+                                          purpose="assistants")
+        cached = CachedFile(sha256=sha256, file_id=response.id, tokens=tokens, encoding=encoding)
+    elif cached.encoding != encoding:
+        cached.tokens = await num_tokens_from_file_async(download.file, model)
+        cached.encoding = encoding
+    _files[sha256] = cached
+    return cached
+
+
+def release_file(cached: CachedFile) -> None:
+    cached.refcount -= 1
+    cached.last_used = time.time()
+    if _files.get(cached.sha256) is cached:
+        save_cached_file(cached)
+
+
+def forget_file(cached: CachedFile) -> None:
+    # Called when the API no longer knows the cached file id.
+    _files.pop(cached.sha256, None)
+    delete_cached_file(cached.sha256)
+
+
+def start_file_gc() -> None:
+    global _gc_task
+    if _gc_task is None or _gc_task.done():
+        _gc_task = asyncio.create_task(run_file_gc())
+
+
+def stop_file_gc() -> None:
+    if _gc_task is not None:
+        _gc_task.cancel()
+
+
+async def run_file_gc() -> None:
+    while True:
+        cutoff = time.time() - get_config().file_cache_ttl
+        for cached in await run_database_read(load_expired_files, cutoff):
+            current = _files.get(cached.sha256, cached)
+            if current.refcount > 0 or current.last_used >= cutoff:
+                continue
+            _files.pop(cached.sha256, None)
+            delete_cached_file(cached.sha256)
+            schedule_cleanup(lambda api, file_id=cached.file_id: api.files.delete(file_id))
+        await asyncio.sleep(get_config().file_cache_gc_interval)
@@ -1,18 +1,159 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, Optional
+
 from openai import AsyncOpenAI
 
+from storage.classes import Model
 from storage.confighelper import get_config
 
 api = None
+scheduler = None
+
+
+class TokenBucket:
+    def __init__(self, per_minute: int) -> None:
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: int) -> float:
+        self.refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: int) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount: int) -> None:
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def drain(self) -> None:
+        self.refill()
+        self.tokens = min(self.tokens, 0.0)
+
+
+class ScheduledRequest:
+    def __init__(self, model_name: str, estimated_tokens: int) -> None:
+        self.model_name = model_name
+        self.estimated_tokens = estimated_tokens
+        self.used_tokens: Optional[int] = None
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class RequestScheduler:
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, max_concurrency: int,
+                 rate_limits: Dict[str, list[int]]) -> None:
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.rate_limits = rate_limits
+        self.request_buckets: Dict[str, TokenBucket] = {}
+        self.token_buckets: Dict[str, TokenBucket] = {}
+        # One queue per user, served round robin so a single heavy user cannot starve the rest.
+        self.queues: OrderedDict[int, Deque[ScheduledRequest]] = OrderedDict()
+        self.active = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def buckets(self, model_name: str) -> tuple[TokenBucket, TokenBucket]:
+        if model_name not in self.request_buckets:
+            rpm, tpm = self.rate_limits.get(model_name, [self.requests_per_minute, self.tokens_per_minute])
+            self.request_buckets[model_name] = TokenBucket(rpm)
+            self.token_buckets[model_name] = TokenBucket(tpm)
+        return self.request_buckets[model_name], self.token_buckets[model_name]
+
+    @asynccontextmanager
+    async def slot(self, model: Model, user_id: int, estimated_tokens: int) -> AsyncIterator[ScheduledRequest]:
+        request = ScheduledRequest(model.model_name(), estimated_tokens)
+        self.queues.setdefault(user_id, deque()).append(request)
+        self.dispatch()
+        try:
+            await request.future
+        except asyncio.CancelledError:
+            if request.future.done() and not request.future.cancelled():
+                self.active -= 1
+            self.dispatch()
+            raise
+        try:
+            yield request
+        finally:
+            self.active -= 1
+            if request.used_tokens is not None:
+                self.buckets(request.model_name)[1].refund(request.estimated_tokens - request.used_tokens)
+            self.dispatch()
+
+    def rate_limited(self, model: Model) -> None:
+        # The API disagreed with our budget, so hold everything for this model until the buckets refill.
+        request_bucket, token_bucket = self.buckets(model.model_name())
+        request_bucket.drain()
+        token_bucket.drain()
+
+    def dispatch(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        delay = None
+        while self.active < self.max_concurrency and self.queues:
+            granted = False
+            delay = None
+            for user_id in list(self.queues):
+                queue = self.queues[user_id]
+                while queue and queue[0].future.cancelled():
+                    queue.popleft()
+                if not queue:
+                    del self.queues[user_id]
+                    continue
+                request = queue[0]
+                request_bucket, token_bucket = self.buckets(request.model_name)
+                wait = max(request_bucket.wait_time(1), token_bucket.wait_time(request.estimated_tokens))
+                if wait > 0:
+                    delay = wait if delay is None else min(delay, wait)
+                    continue
+                request_bucket.consume(1)
+                token_bucket.consume(request.estimated_tokens)
+                queue.popleft()
+                if queue:
+                    self.queues.move_to_end(user_id)
+                else:
+                    del self.queues[user_id]
+                self.active += 1
+                request.future.set_result(None)
+                granted = True
+                break
+            if not granted:
+                break
+        if delay is not None and self.queues:
+            self.timer = asyncio.get_running_loop().call_later(delay, self.dispatch)
 
 
 def setup_openai():
-    global api
+    global api, scheduler
     api = AsyncOpenAI(
         api_key=get_config().openai_token,
         timeout=get_config().timeout
     )
+    scheduler = RequestScheduler(
+        requests_per_minute=get_config().requests_per_minute,
+        tokens_per_minute=get_config().tokens_per_minute,
+        max_concurrency=get_config().max_concurrent_requests,
+        rate_limits=get_config().rate_limits
+    )
 
 
 # noinspection PyTypeChecker
 async def get_api() -> AsyncOpenAI:
     return api
+
+
+def get_scheduler() -> RequestScheduler:
+    return scheduler
@@ -0,0 +1,47 @@
+from typing import Dict
+
+from storage.classes import GPTConversation, GPTMessage, GPTPrompt, Model, PromptPrefix
+from storage.confighelper import get_config
+from util.tokens import get_encoding, num_tokens_from_message
+
+BOT_NAME = "GPTHelper"
+
+_prefixes: Dict[str, PromptPrefix] = {}
+
+
+def setup_prompt_prefix():
+    # Called once at startup. The configuration is read only then, so the cached prefixes never go stale.
+    _prefixes.clear()
+    for model in Model:
+        get_prompt_prefix(model)
+
+
+def get_prompt_prefix(model: Model) -> PromptPrefix:
+    prefix = _prefixes.get(model.model_name())
+    if prefix is None:
+        prefix = build_prompt_prefix(model)
+        _prefixes[model.model_name()] = prefix
+    return prefix
+
+
+def build_prompt_prefix(model: Model) -> PromptPrefix:
+    encoding = get_encoding(model)
+    header = GPTMessage("system", f"Instructions for {BOT_NAME}: {get_config().instructions}")
+
+    # Whole example conversations are included in order until the token budget is spent.
+    examples = []
+    example_tokens = 0
+    for conversation in get_config().example_conversations:
+        tokens = sum(num_tokens_from_message(GPTPrompt.render_example(message, BOT_NAME), encoding)
+                     for message in conversation.messages)
+        if example_tokens + tokens > get_config().example_token_budget:
+            break
+        examples.append(conversation)
+        example_tokens += tokens
+
+    prompt = GPTPrompt(header=header, examples=examples, convo=GPTConversation([]))
+    messages = prompt.full_render(BOT_NAME)
+    return PromptPrefix(
+        messages=messages,
+        tokens=sum(num_tokens_from_message(message, encoding) for message in messages)
+    )
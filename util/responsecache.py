@@ -0,0 +1,72 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from storage.classes import GPTChannel
+from storage.confighelper import get_config
+from storage.databasehelper import load_cached_response, save_cached_response, run_database_read
+
+
+class ResponseCache:
+    def __init__(self) -> None:
+        self.entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = await run_database_read(load_cached_response, key)
+        if entry is None or entry[1] < time.time() - get_config().response_cache_ttl:
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.remember(key, entry)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: str, reply: str) -> None:
+        entry = (reply, time.time())
+        self.remember(key, entry)
+        save_cached_response(key, entry[0], entry[1])
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def remember(self, key: str, entry: tuple[str, float]) -> None:
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > get_config().response_cache_size:
+            self.entries.popitem(last=False)
+
+
+_response_cache = ResponseCache()
+
+
+def get_response_cache() -> ResponseCache:
+    return _response_cache
+
+
+def response_cache_key(rendered: list[dict[str, str]], channel_config: GPTChannel, max_tokens: int) -> Optional[str]:
+    # Only near-deterministic requests are worth reusing.
+    if not get_config().response_cache_enabled \
+            or channel_config.current_temperature > get_config().response_cache_max_temperature:
+        return None
+    # Speaker names are left out so the same question from different users shares an entry.
+    return request_hash(rendered, channel_config, max_tokens, include_names=False)
+
+
+def request_hash(rendered: list[dict[str, str]], channel_config: GPTChannel, max_tokens: int,
+                 include_names: bool = True) -> str:
+    if not include_names:
+        rendered = [{key: value for key, value in message.items() if key != "name"} for message in rendered]
+    payload = json.dumps({
+        "messages": rendered,
+        "model": channel_config.current_model.model_name(),
+        "temperature": channel_config.current_temperature,
+        "max_tokens": max_tokens,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
@@ -0,0 +1,175 @@
+import asyncio
+import io
+import re
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple, Union
+
+import discord
+
+from storage.confighelper import get_config
+from util.conversationcache import record_reply
+
+MESSAGE_LIMIT = 2000
+FENCE = "```"
+FILE_NOTICE = "The response is too long to show here, so it is attached as a file."
+FENCE_PATTERN = re.compile(r"`{3,}\w*")
+BACKTICKS = re.compile(r"`{3,}")
+MAX_FENCE = 32
+
+
+def split_into_shorter_messages(message: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    # Pack as much as fits into each message, cutting on paragraph, line or word boundaries. A code block that has
+    # to be split is closed at the end of one message and reopened with the same language at the start of the next.
+    chunks = []
+    fence: Optional[str] = None
+    while message:
+        prefix = fence + "\n" if fence else ""
+        if len(prefix) + len(message) <= limit:
+            chunks.append(prefix + message)
+            break
+        # Leave room for closing whichever fence may be open at the cut, the one carried in or one opened here.
+        closing = max([len(closing_fence(fence or FENCE))] + [len(run) for run in BACKTICKS.findall(message[:limit])])
+        budget = limit - len(prefix) - len("\n") - min(closing, MAX_FENCE)
+        cut = find_cut(message, budget, fence)
+        chunk = message[:cut].rstrip()
+        fence = open_fence(chunk, fence)
+        if chunk.strip():
+            chunks.append(prefix + chunk + ("\n" + closing_fence(fence) if fence else ""))
+        message = message[cut:]
+        # Drop the separator that was cut on, but keep the indentation of the next line.
+        message = message[1:] if message.startswith(" ") else message.lstrip("\n")
+    return chunks
+
+
+def find_cut(message: str, budget: int, fence: Optional[str]) -> int:
+    window = message[:budget]
+    cut = -1
+    for separator in ("\n\n", "\n", " "):
+        cut = window.rfind(separator)
+        if cut > budget // 2:
+            break
+    if cut <= 0:
+        cut = budget
+    # Rather than splitting a code block that opens in this message, move it to the next one if it fits there.
+    start = block_start(message[:cut], fence)
+    if start is not None and start > 0:
+        end = message.find("\n" + FENCE, start + len(FENCE))
+        if end != -1 and end + len("\n" + FENCE) - start <= budget:
+            cut = start
+    return cut
+
+
+def block_start(chunk: str, fence: Optional[str]) -> Optional[int]:
+    # Offset of the line that opens the code block still open at the end of the chunk, if it opened here.
+    start = None
+    offset = 0
+    for line in chunk.split("\n"):
+        if line.strip().startswith(FENCE):
+            if fence is None:
+                fence = fence_marker(line)
+                start = offset
+            else:
+                fence = None
+                start = None
+        offset += len(line) + 1
+    return start
+
+
+def open_fence(chunk: str, fence: Optional[str]) -> Optional[str]:
+    for line in chunk.split("\n"):
+        if line.strip().startswith(FENCE):
+            fence = fence_marker(line) if fence is None else None
+    return fence
+
+
+def fence_marker(line: str) -> str:
+    # Only the backticks and the language are carried over, anything else on the opening line stays where it was.
+    # A language too long to be real is dropped so that reopening the block never eats into the next message.
+    marker = FENCE_PATTERN.match(line.strip()).group()
+    if len(marker) > MAX_FENCE:
+        marker = closing_fence(marker)[:MAX_FENCE]
+    return marker
+
+
+def closing_fence(fence: str) -> str:
+    return fence[:len(fence) - len(fence.lstrip("`"))]
+
+
+class ChannelSender:
+    def __init__(self, channel: discord.abc.Messageable) -> None:
+        self.channel = channel
+        # Each entry is either reply text to pack or a callable that makes one API call, such as an edit.
+        self.pending: Deque[Tuple[Union[str, Callable[[], Awaitable[Any]]], asyncio.Future]] = deque()
+        self.task: Optional[asyncio.Task] = None
+
+    async def send(self, text: str) -> None:
+        await self.enqueue(text)
+
+    async def call(self, action: Callable[[], Awaitable[Any]]) -> Any:
+        return await self.enqueue(action)
+
+    async def enqueue(self, item: Union[str, Callable[[], Awaitable[Any]]]) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.process())
+        return await future
+
+    async def process(self) -> None:
+        # Calls for a channel go out one at a time, and consecutive texts are packed into the same messages.
+        while self.pending:
+            item, future = self.pending.popleft()
+            if isinstance(item, str):
+                batch = [(item, future)]
+                while self.pending and isinstance(self.pending[0][0], str):
+                    batch.append(self.pending.popleft())
+                try:
+                    await deliver(self.channel, "\n\n".join(text for text, _ in batch))
+                except Exception as e:
+                    for _, batch_future in batch:
+                        if not batch_future.done():
+                            batch_future.set_exception(e)
+                else:
+                    for _, batch_future in batch:
+                        if not batch_future.done():
+                            batch_future.set_result(None)
+                continue
+            try:
+                result = await item()
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+        if _senders.get(self.channel.id) is self:
+            del _senders[self.channel.id]
+
+
+_senders: Dict[int, ChannelSender] = {}
+
+
+def get_sender(channel: discord.abc.Messageable) -> ChannelSender:
+    sender = _senders.get(channel.id)
+    if sender is None:
+        sender = ChannelSender(channel)
+        _senders[channel.id] = sender
+    return sender
+
+
+async def send_reply(channel: discord.abc.Messageable, text: str) -> None:
+    await get_sender(channel).send(text)
+
+
+def response_file(text: str) -> discord.File:
+    return discord.File(io.BytesIO(text.encode('utf-8')), filename="response.md")
+
+
+async def deliver(channel: discord.abc.Messageable, text: str) -> None:
+    if len(text) > get_config().response_file_threshold:
+        message = await channel.send(FILE_NOTICE, file=response_file(text))
+        record_reply(channel.id, message.id, text)
+        return
+    # discord.py waits out the channel's rate limit bucket between these sends.
+    for chunk in split_into_shorter_messages(text):
+        await channel.send(chunk)
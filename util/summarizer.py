@@ -0,0 +1,170 @@
+import asyncio
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from storage.classes import GPTMessage, GPTRequest, GPTUser, Model
+from storage.confighelper import get_config
+from storage.databasehelper import add_request, save_attachment_digest, load_attachment_digest, run_database_read
+from util.conversationcache import ThreadConversation
+from util.gptapi import get_api, get_scheduler
+from util.singleflight import get_single_flight
+from util.tokens import num_tokens_from_gpt_message, num_tokens_from_string, split_string_async
+
+SUMMARY_MAX_TOKENS = 1024
+DIGEST_CACHE_SIZE = 64
+SUMMARY_INSTRUCTIONS = ("Summarize the conversation below so that an assistant can continue it without the "
+                        "original messages. Keep names, decisions, open questions, code, numbers and any facts "
+                        "the user has shared. If a previous summary is given, fold the new messages into it. "
+                        "Reply with the summary only.")
+DIGEST_MAP_INSTRUCTIONS = ("The text below is one part of a larger file a user has shared. Extract everything an "
+                           "assistant would need to answer questions about it: key facts, names, numbers, dates, "
+                           "errors, code and structure. Be dense and do not add commentary.")
+DIGEST_REDUCE_INSTRUCTIONS = ("The text below is a set of notes taken from consecutive parts of one file. Merge them "
+                              "into a single set of notes, removing repetition but keeping every distinct fact, "
+                              "number, name, error and piece of code.")
+
+# Most recently used digests keyed by (file hash, model name); older ones are read back from the database.
+_digests: OrderedDict[tuple[str, str], str] = OrderedDict()
+
+
+async def compact_conversation(conversation: ThreadConversation,
+                               gpt_user: GPTUser) -> Tuple[Optional[str], List[GPTMessage]]:
+    if not get_config().summarize_conversations:
+        return None, conversation.gpt_messages()
+    entries = [(message_id, message) for message_id, message in conversation.messages
+               if message_id > conversation.summary_until]
+    messages = [message for _, message in entries]
+
+    model = gpt_user.gpt_channel.current_model
+    total = sum(num_tokens_from_gpt_message(message, model) for message in messages)
+    if conversation.summary is not None:
+        total += num_tokens_from_string(conversation.summary, model)
+    if total <= get_config().summary_threshold_tokens:
+        return conversation.summary, messages
+
+    # Keep the newest turns verbatim and fold everything older into the running summary.
+    kept = 0
+    split = len(entries)
+    while split > 0:
+        tokens = num_tokens_from_gpt_message(entries[split - 1][1], model)
+        if kept + tokens > get_config().summary_keep_tokens and split < len(entries):
+            break
+        kept += tokens
+        split -= 1
+    aged = entries[:split]
+    if not aged:
+        return conversation.summary, messages
+
+    summary = await summarize(conversation.summary, [message for _, message in aged], gpt_user)
+    if summary is None:
+        return conversation.summary, messages
+    conversation.summary = summary
+    conversation.summary_until = aged[-1][0]
+    return summary, [message for _, message in entries[split:]]
+
+
+async def summarize(previous: Optional[str], messages: List[GPTMessage], gpt_user: GPTUser) -> Optional[str]:
+    transcript = "\n".join(message.render() for message in messages)
+    if previous is not None:
+        transcript = f"Previous summary:\n{previous}\n\nNew messages:\n{transcript}"
+    return await run_summary(SUMMARY_INSTRUCTIONS, transcript, gpt_user)
+
+
+async def digest_attachment(text: str, sha256: str, gpt_user: GPTUser) -> Optional[str]:
+    # Large text files are summarized chunk by chunk once per file, then reused by every later question about them.
+    model = summary_model()
+    key = (sha256, model.model_name())
+    digest = _digests.get(key)
+    if digest is not None:
+        _digests.move_to_end(key)
+        return digest
+    digest = await run_database_read(load_attachment_digest, sha256, model.model_name())
+    if digest is None:
+        digest, _ = await get_single_flight().do(("digest", sha256, model.model_name()),
+                                                 lambda: map_reduce(text, gpt_user))
+        if digest is None:
+            return None
+        save_attachment_digest(sha256, model.model_name(), digest)
+    _digests[key] = digest
+    if len(_digests) > DIGEST_CACHE_SIZE:
+        _digests.popitem(last=False)
+    return digest
+
+
+async def map_reduce(text: str, gpt_user: GPTUser) -> Optional[str]:
+    model = summary_model()
+    chunk_tokens = get_config().digest_chunk_tokens
+    semaphore = asyncio.Semaphore(get_config().digest_concurrency)
+
+    async def bounded(instructions: str, chunk: str) -> Optional[str]:
+        async with semaphore:
+            return await run_summary(instructions, chunk, gpt_user)
+
+    chunks = await split_string_async(text, model, chunk_tokens)
+    instructions = DIGEST_MAP_INSTRUCTIONS
+    while True:
+        parts = await asyncio.gather(*(bounded(instructions, chunk) for chunk in chunks))
+        if any(part is None for part in parts):
+            return None
+        if len(parts) == 1:
+            return parts[0]
+        combined = "\n\n".join(parts)
+        if num_tokens_from_string(combined, model) <= chunk_tokens:
+            return combined
+        # The partial notes are still too long, so merge neighbouring ones and go again.
+        chunks = group_parts(parts, model, chunk_tokens)
+        instructions = DIGEST_REDUCE_INSTRUCTIONS
+
+
+def group_parts(parts: List[str], model: Model, chunk_tokens: int) -> List[str]:
+    groups = []
+    current = []
+    used = 0
+    for part in parts:
+        tokens = num_tokens_from_string(part, model)
+        if current and used + tokens > chunk_tokens:
+            groups.append("\n\n".join(current))
+            current = []
+            used = 0
+        current.append(part)
+        used += tokens
+    if current:
+        groups.append("\n\n".join(current))
+    if len(groups) == len(parts):
+        # Every part fills a chunk on its own; pair them up so the loop still converges.
+        groups = ["\n\n".join(parts[i: i + 2]) for i in range(0, len(parts), 2)]
+    return groups
+
+
+def summary_model() -> Model:
+    return Model.from_model_name(get_config().summary_model) or Model.GPT_3_5_TURBO
+
+
+async def run_summary(instructions: str, text: str, gpt_user: GPTUser) -> Optional[str]:
+    model = summary_model()
+    rendered = [
+        {"role": "system", "content": instructions},
+        {"role": "user", "content": text},
+    ]
+    estimated_tokens = num_tokens_from_string(text, model) + SUMMARY_MAX_TOKENS
+    try:
+        api = await get_api()
+        async with get_scheduler().slot(model, gpt_user.id, estimated_tokens) as scheduled:
+            response = await api.chat.completions.create(
+                model=model.model_name(),
+                messages=rendered,
+                temperature=0.2,
+                max_tokens=SUMMARY_MAX_TOKENS,
+            )
+            scheduled.used_tokens = response.usage.total_tokens
+    except Exception as e:
+        print(f"Failed to summarize text\n{type(e).__name__}: {e}")
+        return None
+    add_request(gpt_user, GPTRequest(
+        model=model,
+        input_tokens=response.usage.prompt_tokens,
+        output_tokens=response.usage.completion_tokens,
+        channel_id=gpt_user.gpt_channel.id
+    ))
+    summary = response.choices[0].message.content
+    return summary.strip() if summary else None
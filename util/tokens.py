@@ -0,0 +1,193 @@
+import asyncio
+import codecs
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from typing import IO, List, Optional
+
+import tiktoken
+from openai.types.beta.threads import ThreadMessage
+
+from storage.classes import GPTMessage, GPTPrompt, Model
+from storage.confighelper import get_config
+
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+MESSAGE_CACHE_SIZE = 8192
+
+_message_tokens: OrderedDict[tuple[GPTMessage, str, str], int] = OrderedDict()
+_executor: Optional[Executor] = None
+
+
+def setup_tokenizer_pool():
+    global _executor
+    if get_config().tokenizer_pool == "process":
+        # Workers are forked immediately, so this must run before any other thread is started.
+        _executor = ProcessPoolExecutor(max_workers=get_config().tokenizer_workers,
+                                        mp_context=multiprocessing.get_context("fork"))
+        _executor.submit(get_encoding_by_name, Model.GPT_4_TURBO.model_name())
+    elif get_config().tokenizer_pool == "thread":
+        _executor = ThreadPoolExecutor(max_workers=get_config().tokenizer_workers, thread_name_prefix="tokenizer")
+
+
+def close_tokenizer_pool():
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+
+
+def is_inline(size: int) -> bool:
+    return _executor is None or size < get_config().inline_tokenize_threshold
+
+
+async def run_in_pool(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(_executor, function, *args)
+
+
+def get_encoding(model: Model):
+    return get_encoding_by_name(model.model_name())
+
+
+@lru_cache(maxsize=None)
+def get_encoding_by_name(model_name: str):
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        print("Warning: model not found. Using cl100k_base encoding.")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def num_tokens_from_message(message: dict[str, str], encoding) -> int:
+    num_tokens = TOKENS_PER_MESSAGE
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(text=value, disallowed_special=()))
+        if key == "name":
+            num_tokens += TOKENS_PER_NAME
+    return num_tokens
+
+
+def num_tokens_from_message_by_name(message: dict[str, str], model_name: str) -> int:
+    return num_tokens_from_message(message, get_encoding_by_name(model_name))
+
+
+def num_tokens_from_gpt_message(message: GPTMessage, model: Model, bot_name: str = "GPTHelper") -> int:
+    # GPTMessage is frozen, so each turn of a conversation is only encoded once while it stays in the cache.
+    key = (message, model.model_name(), bot_name)
+    tokens = _message_tokens.get(key)
+    if tokens is not None:
+        _message_tokens.move_to_end(key)
+        return tokens
+    tokens = num_tokens_from_message(GPTPrompt.render_message(message, bot_name), get_encoding(model))
+    remember_message_tokens(key, tokens)
+    return tokens
+
+
+async def prime_gpt_message_tokens(messages: List[GPTMessage], model: Model, bot_name: str = "GPTHelper") -> None:
+    # Count large turns in the pool up front so building the context afterwards only hits the cache.
+    for message in messages:
+        key = (message, model.model_name(), bot_name)
+        if message.text is None or is_inline(len(message.text)) or key in _message_tokens:
+            continue
+        tokens = await run_in_pool(num_tokens_from_message_by_name, GPTPrompt.render_message(message, bot_name),
+                                   model.model_name())
+        remember_message_tokens(key, tokens)
+
+
+def remember_message_tokens(key: tuple[GPTMessage, str, str], tokens: int) -> None:
+    _message_tokens[key] = tokens
+    if len(_message_tokens) > MESSAGE_CACHE_SIZE:
+        _message_tokens.popitem(last=False)
+
+
+def num_tokens_from_messages(messages: list[dict[str, str]], model: Model) -> int:
+    encoding = get_encoding(model)
+    num_tokens = 0
+    for message in messages:
+        num_tokens += num_tokens_from_message(message, encoding)
+    num_tokens += 3
+    return num_tokens
+
+
+def num_tokens_from_list(messages: list[ThreadMessage], model: Model) -> int:
+    encoding = get_encoding(model)
+    num_tokens = 0
+    for processed in messages:
+        if processed.role == "assistant":
+            num_tokens += TOKENS_PER_MESSAGE
+            num_tokens += len(encoding.encode(text=processed.content[0].text.value, disallowed_special=()))
+    return num_tokens
+
+
+def decode_bytes(file_data: bytes) -> str:
+    try:
+        return file_data.decode('utf-8')
+    except UnicodeDecodeError:
+        try:
+            return file_data.decode('ISO-8859-1')
+        except UnicodeDecodeError:
+            return file_data.decode('latin1', errors='ignore')
+
+
+def num_tokens_from_bytes(file_data: bytes, model: Model) -> int:
+    return num_tokens_from_bytes_by_name(file_data, model.model_name())
+
+
+def num_tokens_from_bytes_by_name(file_data: bytes, model_name: str) -> int:
+    return len(get_encoding_by_name(model_name).encode(text=decode_bytes(file_data), disallowed_special=()))
+
+
+def num_tokens_from_string(file_data: str, model: Model) -> int:
+    return num_tokens_from_string_by_name(file_data, model.model_name())
+
+
+def num_tokens_from_string_by_name(file_data: str, model_name: str) -> int:
+    return len(get_encoding_by_name(model_name).encode(text=file_data, disallowed_special=()))
+
+
+async def num_tokens_from_bytes_async(file_data: bytes, model: Model) -> int:
+    if is_inline(len(file_data)):
+        return num_tokens_from_bytes(file_data, model)
+    return await run_in_pool(num_tokens_from_bytes_by_name, file_data, model.model_name())
+
+
+async def num_tokens_from_string_async(file_data: str, model: Model) -> int:
+    if is_inline(len(file_data)):
+        return num_tokens_from_string(file_data, model)
+    return await run_in_pool(num_tokens_from_string_by_name, file_data, model.model_name())
+
+
+def split_string_by_name(file_data: str, model_name: str, chunk_tokens: int) -> List[str]:
+    encoding = get_encoding_by_name(model_name)
+    tokens = encoding.encode(text=file_data, disallowed_special=())
+    return [encoding.decode(tokens[i: i + chunk_tokens]) for i in range(0, len(tokens), chunk_tokens)]
+
+
+async def split_string_async(file_data: str, model: Model, chunk_tokens: int) -> List[str]:
+    if is_inline(len(file_data)):
+        return split_string_by_name(file_data, model.model_name(), chunk_tokens)
+    return await run_in_pool(split_string_by_name, file_data, model.model_name(), chunk_tokens)
+
+
+async def num_tokens_from_file_async(file: IO[bytes], model: Model, chunk_size: int = 1048576) -> int:
+    # Counted a chunk at a time so large attachments never have to be held in memory at once. The decoder carries
+    # a character split across chunks over to the next one, and a file that is not UTF-8 as a whole is counted as
+    # ISO-8859-1 from the start, the same as decode_bytes would decode it.
+    try:
+        return await num_tokens_from_chunks_async(file, model, chunk_size, 'utf-8')
+    except UnicodeDecodeError:
+        return await num_tokens_from_chunks_async(file, model, chunk_size, 'ISO-8859-1')
+
+
+async def num_tokens_from_chunks_async(file: IO[bytes], model: Model, chunk_size: int, encoding: str) -> int:
+    decoder = codecs.getincrementaldecoder(encoding)()
+    num_tokens = 0
+    file.seek(0)
+    while chunk := file.read(chunk_size):
+        num_tokens += await num_tokens_from_string_async(decoder.decode(chunk), model)
+    return num_tokens + await num_tokens_from_string_async(decoder.decode(b"", final=True), model)
+
+
+async def decode_bytes_async(file_data: bytes) -> str:
+    if is_inline(len(file_data)):
+        return decode_bytes(file_data)
+    return await run_in_pool(decode_bytes, file_data)
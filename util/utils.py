@@ -1,18 +1,27 @@
+import time
+from dataclasses import replace
 from typing import Optional, List
 
 import discord
 import openai
-import tiktoken
 from discord import Message as DiscordMessage
 from openai.types.beta.thread_create_params import Message
-from openai.types.beta.threads import ThreadMessage
 
-from storage.classes import GPTMessage, GPTUser, GPTRequest, GPTChannel, GPTPrompt, GPTConversation, OpenAIResponse, \
+from storage.classes import GPTMessage, GPTUser, GPTRequest, GPTChannel, GPTPrompt, OpenAIResponse, \
     OpenAIResult
 from storage.confighelper import get_config
 from storage.databasehelper import add_request
 from util.builder import geterrorembedbuilder
-from util.gptapi import get_api
+from util.conversationcache import record_reply
+from util.gptapi import get_api, get_scheduler
+from util.promptprefix import get_prompt_prefix
+from util.responsecache import get_response_cache, response_cache_key, request_hash
+from util.sender import split_into_shorter_messages, send_reply, get_sender, response_file, FILE_NOTICE
+from util.singleflight import get_single_flight
+from util.tokens import get_encoding, num_tokens_from_message, num_tokens_from_messages, num_tokens_from_gpt_message, \
+    num_tokens_from_string
+
+MIN_REPLY_TOKENS = 256
 
 
 def discord_message_to_gptmessage(message: DiscordMessage) -> Optional[GPTMessage]:
@@ -28,34 +37,89 @@ def gpt_message_to_openai_message(gpt_messages: List[GPTMessage]) -> List[Messag
     return messages
 
 
-def split_into_shorter_messages(message: str) -> List[str]:
-    return [
-        message[i: i + 1700]
-        for i in range(0, len(message), 1700)
-    ]
+def build_context(messages: List[GPTMessage], channel_config: GPTChannel,
+                  summary: Optional[str] = None) -> tuple[list[dict[str, str]], int, int]:
+    model = channel_config.current_model
+    prefix = get_prompt_prefix(model)
+    rendered = list(prefix.messages)
+    # Every reply is primed with 3 tokens on top of the messages.
+    base_tokens = prefix.tokens + 3
+    if summary is not None:
+        rendered.append(GPTPrompt.render_summary(summary))
+        base_tokens += num_tokens_from_message(rendered[-1], get_encoding(model))
+    max_tokens = channel_config.current_max_tokens
+    budget = model.context_window() - base_tokens - max_tokens
+
+    # Keep the newest turns that fit next to the requested reply size and drop the oldest ones.
+    kept = []
+    used = 0
+    for message in reversed(messages):
+        if message.text is None:
+            continue
+        rendered_message = GPTPrompt.render_message(message, "GPTHelper")
+        tokens = num_tokens_from_gpt_message(message, model)
+        if used + tokens > budget:
+            if not kept:
+                # The newest message alone is too large, so shrink the reply and truncate the message if needed.
+                budget = model.context_window() - base_tokens - MIN_REPLY_TOKENS
+                encoding = get_encoding(model)
+                rendered_message = truncate_message(rendered_message, budget, encoding)
+                tokens = num_tokens_from_message(rendered_message, encoding)
+                kept.append(rendered_message)
+                used += tokens
+            break
+        kept.append(rendered_message)
+        used += tokens
+    kept.reverse()
+    rendered.extend(kept)
+    max_tokens = max(1, min(max_tokens, model.context_window() - base_tokens - used))
+    return rendered, max_tokens, base_tokens + used
+
 
+def truncate_message(message: dict[str, str], max_tokens: int, encoding) -> dict[str, str]:
+    overhead = num_tokens_from_message({**message, "content": ""}, encoding)
+    content_tokens = encoding.encode(text=message["content"], disallowed_special=())
+    keep = max(0, max_tokens - overhead)
+    if len(content_tokens) <= keep:
+        return message
+    return {**message, "content": encoding.decode(content_tokens[:keep])}
 
-async def generate_completion_response(messages: List[GPTMessage], channel_config: GPTChannel) -> OpenAIResponse:
+
+async def generate_completion_response(messages: List[GPTMessage], channel_config: GPTChannel,
+                                       user_id: int, summary: Optional[str] = None) -> OpenAIResponse:
     rendered = None
     try:
-        prompt = GPTPrompt(
-            header=GPTMessage(
-                "system", f"Instructions for GPTHelper: {get_config().instructions}"
-            ),
-            examples=get_config().example_conversations,
-            convo=GPTConversation(messages),
+        rendered, max_tokens, prompt_tokens = build_context(messages, channel_config, summary)
+        cache_key = response_cache_key(rendered, channel_config, max_tokens)
+        if cache_key is not None and (cached := await get_response_cache().get(cache_key)) is not None:
+            return cached_response(cached)
+        response, shared = await get_single_flight().do(
+            ("completion", request_hash(rendered, channel_config, max_tokens)),
+            lambda: request_completion(rendered, channel_config, user_id, max_tokens, prompt_tokens, cache_key)
         )
-        rendered = prompt.full_render("GPTHelper")
+        return shared_response(response) if shared else response
+    except Exception as e:
+        return error_response(e, rendered, channel_config)
+
+
+async def request_completion(rendered: list[dict[str, str]], channel_config: GPTChannel, user_id: int,
+                             max_tokens: int, prompt_tokens: int, cache_key: Optional[str]) -> OpenAIResponse:
+    try:
         api = await get_api()
-        response = await api.chat.completions.create(
-            model=channel_config.current_model.model_name(),
-            messages=rendered,
-            temperature=channel_config.current_temperature,
-            top_p=1.0,
-            max_tokens=channel_config.current_max_tokens,
-            stop=["<|endoftext|>"],
-        )
+        estimated_tokens = prompt_tokens + max_tokens
+        async with get_scheduler().slot(channel_config.current_model, user_id, estimated_tokens) as scheduled:
+            response = await api.chat.completions.create(
+                model=channel_config.current_model.model_name(),
+                messages=rendered,
+                temperature=channel_config.current_temperature,
+                top_p=1.0,
+                max_tokens=max_tokens,
+                stop=["<|endoftext|>"],
+            )
+            scheduled.used_tokens = response.usage.total_tokens
         reply = response.choices[0].message.content.strip()
+        if cache_key is not None and reply:
+            get_response_cache().put(cache_key, reply)
         return OpenAIResponse(
             status=OpenAIResult.OK,
             prompt_tokens=response.usage.prompt_tokens,
@@ -63,11 +127,105 @@ async def generate_completion_response(messages: List[GPTMessage], channel_confi
             reply_text=reply,
             status_text=None
         )
-    except openai.BadRequestError as e:
+    except Exception as e:
+        return error_response(e, rendered, channel_config)
+
+
+async def stream_completion_response(messages: List[GPTMessage], channel_config: GPTChannel, user_id: int,
+                                     thread: discord.Thread, summary: Optional[str] = None) -> OpenAIResponse:
+    rendered = None
+    try:
+        rendered, max_tokens, prompt_tokens = build_context(messages, channel_config, summary)
+        cache_key = response_cache_key(rendered, channel_config, max_tokens)
+        if cache_key is not None and (cached := await get_response_cache().get(cache_key)) is not None:
+            return cached_response(cached)
+        # The first caller streams into its own thread; identical concurrent callers get the finished reply.
+        response, shared = await get_single_flight().do(
+            ("completion", request_hash(rendered, channel_config, max_tokens)),
+            lambda: request_streamed_completion(rendered, channel_config, user_id, max_tokens, prompt_tokens,
+                                                cache_key, thread)
+        )
+        return shared_response(response) if shared else response
+    except Exception as e:
+        return error_response(e, rendered, channel_config)
+
+
+async def request_streamed_completion(rendered: list[dict[str, str]], channel_config: GPTChannel, user_id: int,
+                                      max_tokens: int, prompt_tokens: int, cache_key: Optional[str],
+                                      thread: discord.Thread) -> OpenAIResponse:
+    try:
+        api = await get_api()
+        estimated_tokens = prompt_tokens + max_tokens
+        async with get_scheduler().slot(channel_config.current_model, user_id, estimated_tokens) as scheduled:
+            stream = await api.chat.completions.create(
+                model=channel_config.current_model.model_name(),
+                messages=rendered,
+                temperature=channel_config.current_temperature,
+                top_p=1.0,
+                max_tokens=max_tokens,
+                stop=["<|endoftext|>"],
+                stream=True,
+            )
+            reply = StreamingReply(thread, get_config().stream_edit_interval)
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    await reply.append(chunk.choices[0].delta.content)
+            reply_text = reply.text.strip()
+            # Streamed responses carry no usage block, so both sides are counted locally.
+            completion_tokens = num_tokens_from_string(reply_text, channel_config.current_model)
+            scheduled.used_tokens = prompt_tokens + completion_tokens
+        await reply.finish()
+        if cache_key is not None and reply_text:
+            get_response_cache().put(cache_key, reply_text)
+        return OpenAIResponse(
+            status=OpenAIResult.OK,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            reply_text=reply_text,
+            status_text=None,
+            delivered=len(reply.messages) > 0
+        )
+    except Exception as e:
+        return error_response(e, rendered, channel_config)
+
+
+def shared_response(response: OpenAIResponse) -> OpenAIResponse:
+    # The caller that made the request already recorded its cost and delivered it to its own thread.
+    return replace(
+        response,
+        prompt_tokens=0,
+        completion_tokens=0 if response.completion_tokens is not None else None,
+        delivered=False
+    )
+
+
+def cached_response(reply_text: str) -> OpenAIResponse:
+    # Cache hits are delivered like any other reply but cost nothing.
+    return OpenAIResponse(
+        status=OpenAIResult.OK,
+        prompt_tokens=0,
+        completion_tokens=0,
+        reply_text=reply_text,
+        status_text=None
+    )
+
+
+def error_response(e: Exception, rendered: Optional[list[dict[str, str]]], channel_config: GPTChannel) -> OpenAIResponse:
+    prompt_tokens = num_tokens_from_messages(rendered, channel_config.current_model) if rendered else 0
+    if isinstance(e, openai.RateLimitError):
+        get_scheduler().rate_limited(channel_config.current_model)
+        return OpenAIResponse(
+            status=OpenAIResult.RATE_LIMITED,
+            prompt_tokens=0,
+            completion_tokens=None,
+            reply_text=None,
+            status_text=str(e)
+        )
+    if isinstance(e, openai.BadRequestError):
         if "This model's maximum context length" in str(e):
             return OpenAIResponse(
                 status=OpenAIResult.TOO_LONG,
-                prompt_tokens=num_tokens_from_messages(rendered, channel_config.current_model),
+                prompt_tokens=prompt_tokens,
                 completion_tokens=None,
                 reply_text=None,
                 status_text=str(e)
@@ -76,20 +234,76 @@ async def generate_completion_response(messages: List[GPTMessage], channel_confi
             print(e)
             return OpenAIResponse(
                 status=OpenAIResult.INVALID_REQUEST,
-                prompt_tokens=num_tokens_from_messages(rendered, channel_config.current_model),
+                prompt_tokens=prompt_tokens,
                 completion_tokens=None,
                 reply_text=None,
                 status_text=str(e),
             )
-    except Exception as e:
-        print(e)
-        return OpenAIResponse(
-            status=OpenAIResult.OTHER_ERROR,
-            prompt_tokens=num_tokens_from_messages(rendered, channel_config.current_model),
-            completion_tokens=None,
-            reply_text=None,
-            status_text=str(e)
-        )
+    print(e)
+    return OpenAIResponse(
+        status=OpenAIResult.OTHER_ERROR,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=None,
+        reply_text=None,
+        status_text=str(e)
+    )
+
+
+class StreamingReply:
+    def __init__(self, thread: discord.Thread, interval: float) -> None:
+        self.thread = thread
+        self.interval = interval
+        self.text = ""
+        self.messages: List[discord.Message] = []
+        self.contents: List[str] = []
+        self.last_render = 0.0
+        self.as_file = False
+
+    async def append(self, delta: str) -> None:
+        self.text += delta
+        # Post as soon as the first tokens arrive, then edit at most once per interval.
+        if not self.messages or time.monotonic() - self.last_render >= self.interval:
+            await self.render()
+
+    async def render(self) -> None:
+        text = self.text.strip()
+        if len(text) > get_config().response_file_threshold:
+            # Too long for messages: collapse what was streamed into one notice and attach the text when done.
+            if not self.as_file:
+                await self.collapse()
+            self.last_render = time.monotonic()
+            return
+        sender = get_sender(self.thread)
+        for index, chunk in enumerate(split_into_shorter_messages(text)):
+            if index < len(self.messages):
+                if self.contents[index] != chunk:
+                    await sender.call(lambda message=self.messages[index], chunk=chunk: message.edit(content=chunk))
+                    self.contents[index] = chunk
+            else:
+                self.messages.append(await sender.call(lambda chunk=chunk: self.thread.send(chunk)))
+                self.contents.append(chunk)
+        self.last_render = time.monotonic()
+
+    async def collapse(self) -> None:
+        sender = get_sender(self.thread)
+        notice = "Writing a long response, it will be attached as a file when it is done."
+        for message in self.messages[1:]:
+            await sender.call(message.delete)
+        if self.messages:
+            self.messages = [await sender.call(lambda: self.messages[0].edit(content=notice))]
+        else:
+            self.messages = [await sender.call(lambda: self.thread.send(notice))]
+        self.contents = [notice]
+        self.as_file = True
+
+    async def finish(self) -> None:
+        await self.render()
+        if self.as_file:
+            text = self.text.strip()
+            await get_sender(self.thread).call(
+                lambda: self.messages[0].edit(content=FILE_NOTICE, attachments=[response_file(text)])
+            )
+            record_reply(self.thread.id, self.messages[0].id, text)
 
 
 async def process_response(gpt_user: GPTUser, thread: discord.Thread, response_data: OpenAIResponse):
@@ -100,18 +314,21 @@ async def process_response(gpt_user: GPTUser, thread: discord.Thread, response_d
         input_tokens=response_data.prompt_tokens,
         output_tokens=response_data.completion_tokens or 0,
         model=gpt_user.gpt_channel.current_model,
+        channel_id=gpt_user.gpt_channel.id,
     ))
     if status is OpenAIResult.OK:
         if not reply_text:
             await thread.send(
                 embed=geterrorembedbuilder("Error", "No response from the model. Please try again.")
             )
-        else:
-            shorter_response = split_into_shorter_messages(reply_text)
-            for r in shorter_response:
-                await thread.send(r)
+        elif not response_data.delivered:
+            await send_reply(thread, reply_text)
     elif status is OpenAIResult.TOO_LONG:
         await close_thread(thread)
+    elif status is OpenAIResult.RATE_LIMITED:
+        await thread.send(
+            embed=geterrorembedbuilder("Rate Limited", "The bot is receiving too many requests. Please try again shortly.")
+        )
     elif status is OpenAIResult.INVALID_REQUEST:
         await thread.send(
             embed=geterrorembedbuilder("Invalid Request", f"**Error** - {status_text}")
@@ -128,63 +345,3 @@ async def close_thread(thread: discord.Thread):
                                    "The thread has reached the model's context limit. Please restart the chat and ask the question again.")
     )
     await thread.edit(archived=True, locked=True)
-
-
-def num_tokens_from_messages(messages: list[dict[str, str]], model):
-    try:
-        encoding = tiktoken.encoding_for_model(model.model_name())
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    tokens_per_message = 3
-    tokens_per_name = 1
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(text=value, allowed_special={'<|endoftext|>'}))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3
-    return num_tokens
-
-
-def num_tokens_from_list(messages: list[ThreadMessage], model):
-    try:
-        encoding = tiktoken.encoding_for_model(model.model_name())
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    tokens_per_message = 3
-    num_tokens = 0
-    for processed in messages:
-        if processed.role == "assistant":
-            num_tokens += tokens_per_message
-            num_tokens += len(encoding.encode(text=processed.content[0].text.value))
-
-
-def num_tokens_from_bytes(file_data: bytes, model):
-    try:
-        encoding = tiktoken.encoding_for_model(model.model_name())
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-
-    try:
-        string_data = file_data.decode('utf-8')
-    except UnicodeDecodeError:
-        try:
-            string_data = file_data.decode('ISO-8859-1')
-        except UnicodeDecodeError:
-            string_data = file_data.decode('latin1', errors='ignore')
-
-    return len(encoding.encode(text=string_data))
-
-
-def num_tokens_from_string(file_data: str, model):
-    try:
-        encoding = tiktoken.encoding_for_model(model.model_name())
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    return len(encoding.encode(text=file_data))